@@ -0,0 +1,290 @@
+########################
+#### Offline benchmark of dashboard_custom: synthetic Aurora fleets against an in-process stand-in of RDS/CloudWatch,
+###  no AWS account or network is used.
+#### Flows: init, update, sync, tag of the CLI, and index/encode of the dashboard model on the synced dashboard.
+#### Each flow reports seconds, API calls and throttles, and with --alloc the peak python allocation, results are written as JSON to compare runs.
+#### Fleets are sized by clusters and instances per cluster (--densities), dashboards by the metric lines of one widget (--linesPerWidget).
+#### usage: python benchmark_dashboard.py --fleets 10,100,1000 --densities 2,4 --linesPerWidget 0,50 --throttleRate 0.01 --alloc --out benchmark_results.json
+########################
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from typing import List, Dict
+
+import dashboard_custom
+
+BENCH_REGION = 'ap-northeast-1'
+BENCH_ACCOUNT = '123456789012'
+BENCH_DASHBOARD = 'bench'
+# page sizes of the real APIs
+DESCRIBE_DB_CLUSTERS_PAGE = 100
+GET_RESOURCES_PAGE = 100
+LIST_DASHBOARDS_PAGE = 1000
+
+def args_parse():
+    parser = argparse.ArgumentParser(description='Benchmark dashboard_custom offline with synthetic fleets')
+    parser.add_argument('--fleets', help='Cluster numbers of the synthetic fleets, default 10,100,1000, optional', default='10,100,1000', required=False)
+    parser.add_argument('--densities', help='Instances per cluster of the synthetic fleets, a writer and readers, default 2,4, optional', default='2,4', required=False)
+    parser.add_argument('--linesPerWidget', help='Metric lines of one widget of the synthetic dashboards, full widgets are repeated (--shard widgets), 0 keeps one widget per metric, default 0, optional', default='0', required=False)
+    parser.add_argument('--flows', help='Flows to run in order, default init,update,sync,tag,index,encode, optional', default='init,update,sync,tag,index,encode', required=False)
+    parser.add_argument('--throttleRate', help='Share of API calls throttled by the stand-in, default 0.01, optional', type=float, default=0.01, required=False)
+    parser.add_argument('--workers', help='Threads of dashboard_custom, default 8, optional', type=int, default=8, required=False)
+    parser.add_argument('--template', help='Dashboard template of the synthetic dashboards, default %s, optional' % dashboard_custom.DEFAULT_TEMPLATE, default=dashboard_custom.DEFAULT_TEMPLATE, required=False)
+    parser.add_argument('--alloc', action='store_true', help='Run the flows once more under tracemalloc for their peak allocation, tracemalloc slows them down so seconds come from the first run, optional')
+    parser.add_argument('--seed', help='Seed of the throttling, default 0, optional', type=int, default=0, required=False)
+    parser.add_argument('--out', help='JSON file of the results, default benchmark_results.json, optional', default='benchmark_results.json', required=False)
+    return parser.parse_args()
+
+class FakeClientError(Exception):
+    def __init__(self, code: str, operationName: str):
+        super().__init__("An error occurred (%s) when calling the %s operation" % (code, operationName))
+        self.response = {'Error': {'Code': code, 'Message': code}}
+
+'''
+    In-process stand-in of RDS, Resource Groups Tagging API, CloudWatch, STS and EC2 for one synthetic fleet
+    paginated calls are cut into pages like AWS and throttled calls are retried inside, as botocore does, counted in ResponseMetadata.RetryAttempts
+    single calls like add_tags_to_resource raise a Throttling error for the caller's backoff
+'''
+class FakeAws:
+    def __init__(self, clusterNum: int, instancesPerCluster: int, throttleRate: float = 0.0, seed: int = 0):
+        self.clusterNum = clusterNum
+        self.instancesPerCluster = instancesPerCluster
+        self.throttleRate = throttleRate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.dashboards = {}
+        self.callCountMap = {}
+        self.throttleNum = 0
+        self.clusters = [self.buildCluster(k) for k in range(clusterNum)]
+
+    # cluster k is tagged env:prod or env:dev by turns and one of 10 teams
+    def buildCluster(self, k: int) -> Dict:
+        clusterId = "bench-%05d" % k
+        return {'DBClusterIdentifier': clusterId,
+                'DBClusterArn': dashboard_custom.buildClusterArn(clusterId, BENCH_REGION, BENCH_ACCOUNT),
+                'TagList': [{'Key': 'env', 'Value': 'prod' if k % 2 == 0 else 'dev'}, {'Key': 'team', 'Value': 'team%d' % (k % 10)}],
+                'DBClusterMembers': [{'DBInstanceIdentifier': "%s-%d" % (clusterId, j), 'IsClusterWriter': j == 0} for j in range(self.instancesPerCluster)]}
+
+    # count a call, return the times it was throttled before it went through
+    def call(self, operationName: str) -> int:
+        with self.lock:
+            self.callCountMap[operationName] = self.callCountMap.get(operationName, 0) + 1
+            retryNum = 0
+            while self.random.random() < self.throttleRate:
+                retryNum = retryNum + 1
+            self.throttleNum = self.throttleNum + retryNum
+            return retryNum
+
+    # count a single call, raise Throttling when it is throttled
+    def callOnce(self, operationName: str):
+        with self.lock:
+            self.callCountMap[operationName] = self.callCountMap.get(operationName, 0) + 1
+            if self.random.random() < self.throttleRate:
+                self.throttleNum = self.throttleNum + 1
+                raise FakeClientError('Throttling', operationName)
+
+    def client(self, srvName: str, region: str):
+        return FakeClient(self, srvName, region)
+
+class FakePaginator:
+    def __init__(self, fakeAws: FakeAws, operationName: str, itemsFunc, itemsKey: str, pageSize: int):
+        self.fakeAws = fakeAws
+        self.operationName = operationName
+        self.itemsFunc = itemsFunc
+        self.itemsKey = itemsKey
+        self.pageSize = pageSize
+
+    def paginate(self, **kwargs):
+        items = self.itemsFunc(**kwargs)
+        for k in range(0, max(len(items), 1), self.pageSize):
+            retryNum = self.fakeAws.call(self.operationName)
+            yield {self.itemsKey: items[k:k + self.pageSize], 'ResponseMetadata': {'HTTPStatusCode': 200, 'RetryAttempts': retryNum}}
+
+# operation methods of FakeClient, method name -> API name
+FAKE_OPERATIONS = {'list_dashboards': 'ListDashboards', 'get_dashboard': 'GetDashboard', 'put_dashboard': 'PutDashboard',
+                   'add_tags_to_resource': 'AddTagsToResource', 'remove_tags_from_resource': 'RemoveTagsFromResource',
+                   'get_metric_data': 'GetMetricData', 'get_caller_identity': 'GetCallerIdentity', 'describe_regions': 'DescribeRegions'}
+
+class FakeClient:
+    def __init__(self, fakeAws: FakeAws, srvName: str, region: str):
+        self.fakeAws = fakeAws
+        self.srvName = srvName
+        # the operations are recorded as API calls by dashboard_custom.InstrumentedClient, like botocore's
+        self.meta = type('FakeClientMeta', (), {'region_name': region, 'method_to_api_mapping': FAKE_OPERATIONS})()
+
+    def response(self, retryNum: int = 0, **kwargs) -> Dict:
+        kwargs['ResponseMetadata'] = {'HTTPStatusCode': 200, 'RetryAttempts': retryNum}
+        return kwargs
+
+    def describeDbClusters(self, Filters: List = None, **kwargs) -> List:
+        if not Filters:
+            return self.fakeAws.clusters
+        valueSet = set(Filters[0]['Values'])
+        return [cluster for cluster in self.fakeAws.clusters if cluster['DBClusterIdentifier'] in valueSet or cluster['DBClusterArn'] in valueSet]
+
+    def getResources(self, TagFilters: List = (), **kwargs) -> List:
+        resourceList = []
+        for cluster in self.fakeAws.clusters:
+            tagMap = {tagDict['Key']: tagDict['Value'] for tagDict in cluster['TagList']}
+            if all(tagMap.get(tagFilter['Key']) in tagFilter['Values'] for tagFilter in TagFilters):
+                resourceList.append({'ResourceARN': cluster['DBClusterArn'], 'Tags': cluster['TagList']})
+        return resourceList
+
+    def listDashboards(self, DashboardNamePrefix: str = '', **kwargs) -> List:
+        with self.fakeAws.lock:
+            names = sorted(self.fakeAws.dashboards)
+        return [{'DashboardName': name} for name in names if name.startswith(DashboardNamePrefix)]
+
+    def get_paginator(self, operationName: str) -> FakePaginator:
+        if operationName == 'describe_db_clusters':
+            return FakePaginator(self.fakeAws, operationName, self.describeDbClusters, 'DBClusters', DESCRIBE_DB_CLUSTERS_PAGE)
+        if operationName == 'get_resources':
+            return FakePaginator(self.fakeAws, operationName, self.getResources, 'ResourceTagMappingList', GET_RESOURCES_PAGE)
+        if operationName == 'list_dashboards':
+            return FakePaginator(self.fakeAws, operationName, self.listDashboards, 'DashboardEntries', LIST_DASHBOARDS_PAGE)
+        raise NotImplementedError(operationName)
+
+    def list_dashboards(self, DashboardNamePrefix: str = '', **kwargs) -> Dict:
+        return self.response(self.fakeAws.call('list_dashboards'), DashboardEntries=self.listDashboards(DashboardNamePrefix))
+
+    def get_dashboard(self, DashboardName: str) -> Dict:
+        retryNum = self.fakeAws.call('get_dashboard')
+        with self.fakeAws.lock:
+            dashboardBody = self.fakeAws.dashboards.get(DashboardName)
+        if dashboardBody is None:
+            raise FakeClientError('ResourceNotFound', 'GetDashboard')
+        return self.response(retryNum, DashboardName=DashboardName, DashboardBody=dashboardBody)
+
+    def put_dashboard(self, DashboardName: str, DashboardBody: str) -> Dict:
+        retryNum = self.fakeAws.call('put_dashboard')
+        with self.fakeAws.lock:
+            self.fakeAws.dashboards[DashboardName] = DashboardBody
+        return self.response(retryNum, DashboardValidationMessages=[])
+
+    def add_tags_to_resource(self, ResourceName: str, Tags: List) -> Dict:
+        self.fakeAws.callOnce('add_tags_to_resource')
+        return self.response()
+
+    def remove_tags_from_resource(self, ResourceName: str, TagKeys: List) -> Dict:
+        self.fakeAws.callOnce('remove_tags_from_resource')
+        return self.response()
+
+    def get_metric_data(self, MetricDataQueries: List, StartTime, EndTime, NextToken: str = None) -> Dict:
+        if len(MetricDataQueries) > dashboard_custom.GET_METRIC_DATA_MAX_QUERIES:
+            raise FakeClientError('ValidationError', 'GetMetricData')
+        self.fakeAws.callOnce('get_metric_data')
+        metricResults = [{'Id': query['Id'], 'Values': [float(hash(json.dumps(query, sort_keys=True)) % 100)]} for query in MetricDataQueries]
+        return self.response(MetricDataResults=metricResults)
+
+    def get_caller_identity(self) -> Dict:
+        return self.response(self.fakeAws.call('get_caller_identity'), Account=BENCH_ACCOUNT)
+
+    def describe_regions(self, **kwargs) -> Dict:
+        return self.response(self.fakeAws.call('describe_regions'), Regions=[{'RegionName': BENCH_REGION}])
+
+# point dashboard_custom at the stand-in, its clients and account cache are reset
+def installFakeAws(fakeAws: FakeAws):
+    dashboard_custom.clientMap.clear()
+    dashboard_custom.accountIdMap.clear()
+    dashboard_custom.discoveryCache = dashboard_custom.DiscoveryCache()
+    for srvName in ('rds', 'cloudwatch', 'resourcegroupstaggingapi', 'sts', 'ec2'):
+        dashboard_custom.setClient(srvName, BENCH_REGION, fakeAws.client(srvName, BENCH_REGION))
+
+'''
+    run one flow on the fleet of fakeAws, flows run in order on the same dashboard:
+    init adds the env:dev half of the fleet by cluster id, update adds the env:prod half by tag, sync selects the whole fleet
+    tag writes a tag on every cluster, index and encode rebuild the model of the dashboard and its body
+    return the status and the size of the dashboard body
+'''
+def runFlow(flow: str, fakeAws: FakeAws, templateFile: str, workers: int, linesPerWidget: int = 0) -> Dict:
+    job = {'dashName': BENCH_DASHBOARD, 'region': BENCH_REGION, 'template': templateFile}
+    if linesPerWidget > 0:
+        job.update({'shard': 'widgets', 'maxMetricsPerWidget': linesPerWidget})
+    if flow == 'init':
+        job.update({'action': 'init', 'clusterId': ",".join(cluster['DBClusterIdentifier'] for cluster in fakeAws.clusters[1::2])})
+    elif flow == 'update':
+        job.update({'action': 'update', 'tag': 'env:prod'})
+    elif flow == 'sync':
+        job.update({'action': 'sync', 'tag': 'env:prod OR env:dev'})
+    elif flow == 'tag':
+        clusterIds = ",".join(cluster['DBClusterIdentifier'] for cluster in fakeAws.clusters)
+        resultMap = dashboard_custom.taggingClustersWithTag(clusterIds, BENCH_REGION, 'bench:yes', workers)
+        failedNum = sum(1 for error in resultMap.values() if error is not None)
+        return {'status': 'failed' if failedNum > 0 else 'tagged', 'failed': failedNum}
+    elif flow in ('index', 'encode'):
+        widgets = json.loads(fakeAws.dashboards[BENCH_DASHBOARD])['widgets'] if BENCH_DASHBOARD in fakeAws.dashboards else []
+        model = dashboard_custom.DashboardModel(widgets, dashboard_custom.srvSKU)
+        dashboardBody = model.toBody() if flow == 'encode' else None
+        return {'status': 'done', 'bodyBytes': len(dashboardBody) if dashboardBody is not None else model.bodyBytes}
+    else:
+        raise ValueError("flow %s is invalid" % flow)
+    result = dashboard_custom.runDashboardJob(job, workers)
+    dashboardBody = fakeAws.dashboards.get(BENCH_DASHBOARD, '')
+    widgetNum = len(json.loads(dashboardBody)['widgets']) if dashboardBody else 0
+    return {'status': result['status'], 'instances': result['instances'], 'bodyBytes': len(dashboardBody), 'widgets': widgetNum}
+
+# run every flow on one synthetic fleet, return a result per flow, traceAlloc measures the peak allocation of each flow as well
+def benchmarkFleet(clusterNum: int, instancesPerCluster: int, linesPerWidget: int, flows: List, args, traceAlloc: bool = False) -> List:
+    fakeAws = FakeAws(clusterNum, instancesPerCluster, args.throttleRate, args.seed)
+    installFakeAws(fakeAws)
+    results = []
+    for flow in flows:
+        callCountMap = dict(fakeAws.callCountMap)
+        throttleNum = fakeAws.throttleNum
+        if traceAlloc:
+            tracemalloc.start()
+        startTime = time.perf_counter()
+        flowResult = runFlow(flow, fakeAws, args.template, args.workers, linesPerWidget)
+        seconds = time.perf_counter() - startTime
+        peakBytes = None
+        if traceAlloc:
+            peakBytes = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        apiCallMap = {operationName: count - callCountMap.get(operationName, 0) for operationName, count in fakeAws.callCountMap.items()
+                      if count > callCountMap.get(operationName, 0)}
+        result = {'flow': flow, 'clusters': clusterNum, 'instancesPerCluster': instancesPerCluster, 'linesPerWidget': linesPerWidget,
+                  'seconds': round(seconds, 4), 'peakAllocBytes': peakBytes,
+                  'apiCalls': apiCallMap, 'apiCallTotal': sum(apiCallMap.values()), 'throttles': fakeAws.throttleNum - throttleNum}
+        result.update(flowResult)
+        results.append(result)
+        print("%-7s %6d clusters x %d  %4s lines/widget  %9.3fs%s  %6d calls  %4d throttles  %s" % (flow, clusterNum, instancesPerCluster, linesPerWidget or '-', seconds,
+              "  %8.1f MB peak" % (peakBytes / 1024 / 1024) if traceAlloc else "", result['apiCallTotal'], result['throttles'], flowResult['status']))
+    return results
+
+def main() -> int:
+    args = args_parse()
+    fleets = [int(clusterNum) for clusterNum in args.fleets.split(",")]
+    densities = [int(instancesPerCluster) for instancesPerCluster in args.densities.split(",")]
+    linesPerWidgetList = [int(linesPerWidget) for linesPerWidget in args.linesPerWidget.split(",")]
+    flows = [flow.strip() for flow in args.flows.split(",")]
+    # the logs of dashboard_custom are not formatted and timed, errors still show
+    dashboard_custom.logger.setLevel(logging.ERROR)
+    results = []
+    for clusterNum in fleets:
+        for instancesPerCluster in densities:
+            for linesPerWidget in linesPerWidgetList:
+                fleetResults = benchmarkFleet(clusterNum, instancesPerCluster, linesPerWidget, flows, args)
+                if args.alloc:
+                    for result, allocResult in zip(fleetResults, benchmarkFleet(clusterNum, instancesPerCluster, linesPerWidget, flows, args, True)):
+                        result['peakAllocBytes'] = allocResult['peakAllocBytes']
+                results = results + fleetResults
+    report = {'python': platform.python_version(), 'platform': platform.platform(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+              'options': vars(args), 'results': results}
+    # write the report atomically, so an interrupted run never leaves half a JSON file to compare against
+    fd, tmpFile = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(args.out)), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(tmpFile, args.out)
+    print("Benchmark results are written to %s" % args.out)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
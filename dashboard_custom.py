@@ -5,37 +5,389 @@
 #### Function2: Customer created a dashboard as template from AWS CloudWatch console or Function1, after that, customer can add a instance or many instances
 ###  into each widget of the dashboard.
 #### Function3: Download the cloudWatch dashboard to a local json file as template. --download option
+#### Library: import dashboard_custom and call runDashboardJob / runManifest, nothing runs and boto3 is not imported until an AWS call is made,
+###  clients are cached per service and region and can be injected with setClient.
 #### prerequisite: you need configure ak/sk in AWS CLI first, and make sure you have privileges to call aws SDK api.
 #### created by king_516@126.com , 2023-10-16
 ########################
-import boto3
 import json
+import os
 import re
 import argparse
+import contextlib
+import hashlib
+import logging
+import queue
+import random
+import signal
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from typing import List, Dict
 
-def args_parse():
+# CloudWatch caps the metrics of a graph widget and very dense graphs render slowly, budget of one widget in shard mode
+DEFAULT_MAX_METRICS_PER_WIDGET = 100
+# budget of one dashboard body in shard mode, keep it under the PutDashboard body limit
+DEFAULT_MAX_BODY_BYTES = 1000000
+# local json template of a new dashboard
+DEFAULT_TEMPLATE = 'Aurora_monitor_DashboardBody.json'
+# region of the dashboard when --region all and no --dashRegion
+DEFAULT_REGION = 'ap-northeast-1'
+# discovery cache of --cacheTtl
+DEFAULT_CACHE_DIR = '~/.cache/automatic-create-dashboard'
+DEFAULT_CACHE_MAX_ENTRIES = 1000
+# compact json of the dashboard body, no space after ',' and ':'
+COMPACT_SEPARATORS = (',', ':')
+# CloudWatch caps the query string of one SEARCH expression
+SEARCH_MAX_QUERY_LENGTH = 1024
+# CloudWatch GetMetricData takes up to 500 queries in one call
+GET_METRIC_DATA_MAX_QUERIES = 500
+# id prefix of the SEARCH expression lines written in --mode search, the lines are found again by it when updating
+SEARCH_LINE_ID = 'search'
+# dashboard grid of CloudWatch, widgets without width or height take the default 6x6
+GRID_COLUMNS = 24
+WIDGET_DEFAULT_SIZE = 6
+# graph part of a widget in grid rows, the legend below takes about one row for every two lines of labels
+WIDGET_GRAPH_HEIGHT = 5
+WIDGET_LEGEND_LINES_PER_ROW = 2
+# a label of the legend is about 3 columns wide
+LEGEND_LABEL_COLUMNS = 3
+WIDGET_MAX_HEIGHT = 24
+
+def args_parse(argv: List = None):
     parser = argparse.ArgumentParser(description='Create CloudWatch Dashboard automatically')
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('--init', '-i', action='store_true', help='Create a new dashboard in cloudWatch as local json dashboard body , optional')
     group.add_argument('--update', '-u', action='store_true', help='update dashboard in cloudWatch to add more clusters , optional')
+    group.add_argument('--sync', action='store_true', help='Sync dashboard in cloudWatch with the clusters, add missing instances and delete instances not found any more, put only when changed , optional')
     group.add_argument('--addtag', '-add', action='store_true', help='Add a tag to Aurora clusters , optional')
     group.add_argument('--rmtag', '-rm', action='store_true', help='Remove a tag from Aurora clusters , optional')
-    parser.add_argument('--template', '-t', help='dashboard template file name, mandatory', default='Aurora_monitor_DashboardBody.json', required=False)
+    group.add_argument('--manifest', '-m', help='JSON or YAML file listing many dashboards to init, update or sync in one process, options given here are the defaults of every dashboard, optional', required=False)
+    parser.add_argument('--template', '-t', help='dashboard template file name, default %s, optional' % DEFAULT_TEMPLATE, default=DEFAULT_TEMPLATE, required=False)
     parser.add_argument('--dashName', '-n', help='dashboard template name in aws console, optional', required=False)
     parser.add_argument('--business', '-b', help='business name which to be displayed as cloudwatch dashboard name, optional', required=False)
-    parser.add_argument('--clusterId', '-c', help='Aurora DB cluster identifier in AWS, if tagging or removing tag, can be input like cluster1,cluster2,cluster3', required=False)
-    parser.add_argument('--tag', '-tag', help='Aurora DB cluster tag in console tags, such as RG:UAT or "RG:UAT", resourcegroup:UAT', required=False)
-    parser.add_argument('--region', '-r', help='The Region of Aurora DB cluster identifier, mandatory', default='ap-northeast-1', required=True)
+    parser.add_argument('--clusterId', '-c', help='Aurora DB cluster identifier in AWS, can be input like cluster1,cluster2,cluster3 to add or tag many clusters', required=False)
+    parser.add_argument('--tag', '-tag', help='Aurora DB cluster tag in console tags, such as RG:UAT or "RG:UAT", resourcegroup:UAT. When adding clusters it can be a selector like "env:prod AND team:payments OR tier:gold"', required=False)
+    parser.add_argument('--tagBackend', help='How clusters are found by --tag: describe every cluster and match its tags, or ask the Resource Groups Tagging API for the tagged clusters, default describe, optional', choices=['describe', 'tagging'], default='describe', required=False)
+    parser.add_argument('--region', '-r', help='The Region of Aurora DB cluster identifier, can be input like ap-northeast-1,us-east-1 or all for every region enabled in the account, mandatory', required=False)
+    parser.add_argument('--dashRegion', help='The Region of the cloudWatch dashboard, default the first region of --region, or %s when --region all, optional' % DEFAULT_REGION, required=False)
+    parser.add_argument('--workers', help='Threads to discover regions, put dashboards and write tags at the same time, default 8, optional', type=int, default=8, required=False)
+    parser.add_argument('--cacheTtl', help='Seconds to keep discovered clusters and dashboards in the local discovery cache, 0 disables it, default 0, optional', type=int, default=0, required=False)
+    parser.add_argument('--cacheDir', help='Directory of the discovery cache, default %s, optional' % DEFAULT_CACHE_DIR, default=DEFAULT_CACHE_DIR, required=False)
+    parser.add_argument('--cacheMaxEntries', help='Entries kept in the discovery cache, the oldest are evicted, default %d, optional' % DEFAULT_CACHE_MAX_ENTRIES, type=int, default=DEFAULT_CACHE_MAX_ENTRIES, required=False)
+    parser.add_argument('--refresh', action='store_true', help='Discover again and refresh the discovery cache instead of reading it, optional')
+    parser.add_argument('--arnFromId', action='store_true', help='Build cluster ARNs from the account and the region instead of describing the clusters when marking tags, optional')
     parser.add_argument('--service', '-s', help='The service you want to monitor , default RDS, optional', default='RDS', required=False)
     parser.add_argument('--download', '-d', help='Download the dashboard template from cloudWatch , optional', required=False)
-    args = parser.parse_args()
+    parser.add_argument('--mode', help='How widgets plot the clusters: static writes one metric line per instance, search writes SEARCH expressions selecting the clusters so the body does not grow with the fleet, default static, optional', choices=['static', 'search'], default='static', required=False)
+    parser.add_argument('--searchToken', help='In search mode, select with one unquoted term the clusters whose identifier has this token between hyphens, like prod in pay-prod-1; SEARCH matches the token in any cluster of the region, even out of --clusterId or --tag, optional', required=False)
+    parser.add_argument('--topN', help='Plot only the N hottest instances of each metric plus all writers, ranked by GetMetricData over --rankWindow, re-ranked on each update or sync, optional', type=int, required=False)
+    parser.add_argument('--rankWindow', help='Minutes of metrics to rank the instances by with --topN, default 60, optional', type=int, default=60, required=False)
+    parser.add_argument('--rankStat', help='Statistic of the 5 minute datapoints to rank the instances by with --topN, the highest datapoint of the window is the score, default Average, optional', default='Average', required=False)
+    parser.add_argument('--watch', action='store_true', help='Keep running and update or sync the dashboards of --update, --sync or --manifest whenever the instances of their clusters change, optional')
+    parser.add_argument('--interval', help='Seconds between the discoveries of --watch, default 45, optional', type=float, default=45, required=False)
+    parser.add_argument('--jitter', help='Share of --interval the discoveries are moved randomly by, default 0.1, optional', type=float, default=0.1, required=False)
+    parser.add_argument('--maxStaleness', help='Seconds after which --watch updates a dashboard even when its instances did not change, to bring back edits made out of this tool, default 900, 0 never, optional', type=float, default=900, required=False)
+    parser.add_argument('--cycles', help='Stop --watch after so many discoveries, default 0 runs until stopped, optional', type=int, default=0, required=False)
+    parser.add_argument('--metricsOut', '--metrics-out', help='Write the metrics of the run, AWS call latency, calls, retries, throttles, stage time, body bytes and metric lines, to this file at the end, Prometheus text for a .prom file and json otherwise, optional', required=False)
+    parser.add_argument('--logFormat', help='Log as plain text or as one json object per line, default text, optional', choices=['text', 'json'], default='text', required=False)
+    parser.add_argument('--logLevel', help='Log level, default INFO, optional', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='INFO', required=False)
+    parser.add_argument('--shard', help='Split instances across numbered dashboards <dashName>-1, <dashName>-2 ... or across repeated widgets when a widget or a dashboard is full, optional', choices=['dashboards', 'widgets'], required=False)
+    parser.add_argument('--maxMetricsPerWidget', help='Metric line budget of one widget in shard mode, default %d, optional' % DEFAULT_MAX_METRICS_PER_WIDGET, type=int, default=DEFAULT_MAX_METRICS_PER_WIDGET, required=False)
+    parser.add_argument('--maxBodyBytes', help='Dashboard body budget in bytes in shard mode, default %d, optional' % DEFAULT_MAX_BODY_BYTES, type=int, default=DEFAULT_MAX_BODY_BYTES, required=False)
+    args = parser.parse_args(argv)
     return args
 
+# latency buckets of the histograms in seconds, the last bucket +Inf is implied
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# prefix of the exported metric names
+METRICS_PREFIX = 'aurora_dashboard_'
+
+# log of the tool, the CLI prints it as text or as one json object per line, a library caller configures it as it likes
+logger = logging.getLogger('dashboard_custom')
+
+# one json object per log line, the fields of extra={'fields': {...}} are merged in
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record) -> str:
+        logMap = {'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'), 'level': record.levelname, 'message': record.getMessage()}
+        logMap.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            logMap['exception'] = self.formatException(record.exc_info)
+        return json.dumps(logMap, default=str)
+
+'''
+    Metrics of a run: counters and latency histograms keyed by name and labels, shared by every thread
+    exported at the end of the run as json or as a Prometheus textfile
+'''
+class RunMetrics:
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # (name, ((label, value), ...)) -> value
+        self.counterMap = {}
+        # (name, ((label, value), ...)) -> [count of each bucket ..., sum, count]
+        self.histogramMap = {}
+
+    def count(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counterMap[key] = self.counterMap.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histogramMap.get(key)
+            if histogram is None:
+                histogram = [0] * (len(self.buckets) + 2)
+                self.histogramMap[key] = histogram
+            for j in range(len(self.buckets)):
+                if value <= self.buckets[j]:
+                    histogram[j] = histogram[j] + 1
+                    break
+            histogram[-2] = histogram[-2] + value
+            histogram[-1] = histogram[-1] + 1
+
+    # time a processing stage like discovery or publish
+    @contextlib.contextmanager
+    def stage(self, stageName: str):
+        startTime = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - startTime, stage=stageName)
+
+    def toDict(self) -> Dict:
+        with self.lock:
+            counterList = [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(self.counterMap.items())]
+            histogramList = []
+            for (name, labels), histogram in sorted(self.histogramMap.items()):
+                bucketMap = {}
+                cumulative = 0
+                for j in range(len(self.buckets)):
+                    cumulative = cumulative + histogram[j]
+                    bucketMap[str(self.buckets[j])] = cumulative
+                bucketMap['+Inf'] = histogram[-1]
+                histogramList.append({'name': name, 'labels': dict(labels), 'buckets': bucketMap, 'sum': histogram[-2], 'count': histogram[-1]})
+        return {'counters': counterList, 'histograms': histogramList}
+
+    # Prometheus text exposition format, for the textfile collector of node_exporter
+    def toPrometheus(self) -> str:
+        def labelText(labelMap: Dict) -> str:
+            if len(labelMap) == 0:
+                return ''
+            return '{' + ','.join('%s="%s"' % (label, str(value).replace('\\', '\\\\').replace('"', '\\"')) for label, value in labelMap.items()) + '}'
+        metricsDict = self.toDict()
+        lines = []
+        typedSet = set()
+        for counter in metricsDict['counters']:
+            name = METRICS_PREFIX + counter['name']
+            if name not in typedSet:
+                typedSet.add(name)
+                lines.append('# TYPE %s counter' % name)
+            lines.append('%s%s %s' % (name, labelText(counter['labels']), counter['value']))
+        for histogram in metricsDict['histograms']:
+            name = METRICS_PREFIX + histogram['name']
+            if name not in typedSet:
+                typedSet.add(name)
+                lines.append('# TYPE %s histogram' % name)
+            for le, bucketCount in histogram['buckets'].items():
+                lines.append('%s_bucket%s %d' % (name, labelText(dict(histogram['labels'], le=le)), bucketCount))
+            lines.append('%s_sum%s %s' % (name, labelText(histogram['labels']), histogram['sum']))
+            lines.append('%s_count%s %d' % (name, labelText(histogram['labels']), histogram['count']))
+        return "\n".join(lines) + "\n"
+
+    # write the metrics atomically, Prometheus text for a .prom file and json otherwise
+    def write(self, metricsFile: str):
+        text = self.toPrometheus() if metricsFile.endswith('.prom') else json.dumps(self.toDict(), indent=2)
+        fd, tmpFile = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(metricsFile)), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        os.replace(tmpFile, metricsFile)
+
+# metrics of this process
+runMetrics = RunMetrics()
+
+# record one AWS call: latency, errors, throttles and the retries botocore made inside, from ResponseMetadata.RetryAttempts
+def recordApiCall(srvName: str, operationName: str, seconds: float, response = None, error: Exception = None):
+    runMetrics.count('aws_calls_total', service=srvName, operation=operationName)
+    runMetrics.observe('aws_call_seconds', seconds, service=srvName, operation=operationName)
+    if isinstance(response, dict):
+        retryNum = response.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        if retryNum:
+            runMetrics.count('aws_call_retries_total', retryNum, service=srvName, operation=operationName)
+    if error is not None:
+        errorResponse = getattr(error, 'response', None)
+        code = errorResponse.get('Error', {}).get('Code') if isinstance(errorResponse, dict) else None
+        runMetrics.count('aws_call_errors_total', service=srvName, operation=operationName, code=code or type(error).__name__)
+        if isThrottlingError(error):
+            runMetrics.count('aws_throttles_total', service=srvName, operation=operationName)
+
+# the pages of a paginator, each page is one AWS call
+class InstrumentedPaginator:
+    def __init__(self, paginator, srvName: str, operationName: str):
+        self.paginator = paginator
+        self.srvName = srvName
+        self.operationName = operationName
+
+    def paginate(self, **kwargs):
+        pageIter = iter(self.paginator.paginate(**kwargs))
+        while True:
+            startTime = time.perf_counter()
+            try:
+                page = next(pageIter)
+            except StopIteration:
+                return
+            except Exception as e:
+                recordApiCall(self.srvName, self.operationName, time.perf_counter() - startTime, None, e)
+                raise
+            recordApiCall(self.srvName, self.operationName, time.perf_counter() - startTime, page)
+            yield page
+
+# a client whose API calls are recorded in runMetrics, other attributes like meta, can_paginate or close are the client's
+# the API calls are the operation methods botocore lists in client.meta.method_to_api_mapping
+class InstrumentedClient:
+    def __init__(self, client, srvName: str):
+        self.client = client
+        self.srvName = srvName
+        self.operationNameSet = set(getattr(getattr(client, 'meta', None), 'method_to_api_mapping', None) or ())
+
+    def get_paginator(self, operationName: str) -> InstrumentedPaginator:
+        return InstrumentedPaginator(self.client.get_paginator(operationName), self.srvName, operationName)
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.client, name)
+        if name not in self.operationNameSet or not callable(attr):
+            return attr
+        def callApi(*args, **kwargs):
+            startTime = time.perf_counter()
+            try:
+                response = attr(*args, **kwargs)
+            except Exception as e:
+                recordApiCall(self.srvName, name, time.perf_counter() - startTime, None, e)
+                raise
+            recordApiCall(self.srvName, name, time.perf_counter() - startTime, response)
+            return response
+        return callApi
+
+# yield the items of iterable, the time spent getting them is observed as one stage, the consumer's time in between is not
+def timedIter(stageName: str, iterable):
+    seconds = 0.0
+    iterator = iter(iterable)
+    try:
+        while True:
+            startTime = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                seconds = seconds + time.perf_counter() - startTime
+            yield item
+    finally:
+        runMetrics.observe('stage_seconds', seconds, stage=stageName)
+
+# boto3 clients are thread safe but creating them is not, one cached client per service and region
+# boto3 is imported by the first client made, so importing this module stays cheap
+clientMap = {}
+clientLock = threading.Lock()
+
 def getClient(srvName: str, region_name: str):
-    client = boto3.client(srvName, region_name)
+    with clientLock:
+        client = clientMap.get((srvName, region_name))
+        if client is None:
+            import boto3
+            client = InstrumentedClient(boto3.client(srvName, region_name), srvName)
+            clientMap[(srvName, region_name)] = client
     return client
 
+# use the given client for a service and region, like a client of another boto3 session or credentials, its calls are recorded too
+def setClient(srvName: str, region_name: str, client):
+    with clientLock:
+        clientMap[(srvName, region_name)] = client if isinstance(client, InstrumentedClient) else InstrumentedClient(client, srvName)
+
+# regions enabled in the account, for --region all
+def listRegions(client) -> List:
+    response = client.describe_regions(AllRegions=False)
+    return sorted(regionMap['RegionName'] for regionMap in response['Regions'])
+
+# split the --region input like ap-northeast-1,us-east-1 into a list of regions, 'all' is every region enabled in the account
+def parseRegions(regionInput: str, homeRegion: str) -> List:
+    if regionInput.strip() == 'all':
+        return listRegions(getClient('ec2', homeRegion))
+    return [regionName.strip() for regionName in regionInput.split(",") if regionName.strip() != ""]
+
+'''
+    Discovery cache on local disk, one json file per key like ('instances', account, region, selector)
+    ttl: seconds an entry stays fresh, 0 disables the cache
+    maxEntries: the oldest entries are evicted when there are more files than this
+    refresh: entries are not read but still written, to force one fresh discovery
+    files are written to a temp file and renamed, so concurrent runs never read a half written entry
+'''
+class DiscoveryCache:
+    def __init__(self, cacheDir: str = DEFAULT_CACHE_DIR, ttl: int = 0, maxEntries: int = DEFAULT_CACHE_MAX_ENTRIES, refresh: bool = False):
+        self.cacheDir = os.path.expanduser(cacheDir)
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self.refresh = refresh
+        self.enabled = ttl > 0
+
+    def keyFile(self, key: tuple) -> str:
+        keyHash = hashlib.sha256(json.dumps(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.cacheDir, keyHash + '.json')
+
+    # cached value of the key, None when missing, expired or refreshing
+    def get(self, key: tuple):
+        if not self.enabled or self.refresh:
+            return None
+        try:
+            with open(self.keyFile(key), 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get('key') != list(key) or time.time() - entry.get('time', 0) > self.ttl:
+            return None
+        return entry.get('value')
+
+    def put(self, key: tuple, value):
+        if not self.enabled:
+            return
+        os.makedirs(self.cacheDir, exist_ok=True)
+        fd, tmpFile = tempfile.mkstemp(dir=self.cacheDir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'key': list(key), 'time': time.time(), 'value': value}, f)
+            os.replace(tmpFile, self.keyFile(key))
+        except OSError as e:
+            logger.warning("Write discovery cache error: %s", e)
+            if os.path.exists(tmpFile):
+                os.remove(tmpFile)
+            return
+        self.evict()
+
+    # delete the oldest entries beyond maxEntries, another run may delete the same file at the same time
+    def evict(self):
+        entryList = []
+        for entry in os.scandir(self.cacheDir):
+            if entry.name.endswith('.json'):
+                try:
+                    entryList.append((entry.stat().st_mtime, entry.path))
+                except OSError:
+                    continue
+        if len(entryList) <= self.maxEntries:
+            return
+        entryList.sort()
+        for mtime, path in entryList[:len(entryList) - self.maxEntries]:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+
+# the cache under getClusterInstances and getConsoleWidgets, disabled until the CLI sets --cacheTtl
+discoveryCache = DiscoveryCache()
+
 # get cloudWatch dashboard
 def getDashboard(client, dashName: str):
     response = client.get_dashboard(
@@ -43,164 +395,848 @@ def getDashboard(client, dashName: str):
     )
     return response
 # update dashboard as local dashboard body
-def updateDashboard(client, dashName: str, dashboardBody: str):
+def updateDashboard(client, dashName: str, dashboardBody: str) -> bool:
     try:
-        client.put_dashboard(
-            DashboardName = dashName,
-            DashboardBody = dashboardBody
-        )
+        with runMetrics.stage('publish'):
+            client.put_dashboard(
+                DashboardName = dashName,
+                DashboardBody = dashboardBody
+            )
     except Exception as e:
-        print(e)
+        runMetrics.count('dashboards_put_errors_total')
+        logger.error("Put dashboard %s error: %s", dashName, e, extra={'fields': {'event': 'put_dashboard_error', 'dashName': dashName, 'error': str(e)}})
+        return False
+    runMetrics.count('dashboards_put_total')
+    runMetrics.count('dashboard_body_bytes_total', len(dashboardBody))
+    # the cached dashboard is what was just put, the put went through even when caching it fails
+    if discoveryCache.enabled:
+        try:
+            discoveryCache.put(('dashboard', getAccountId(client.meta.region_name), client.meta.region_name, dashName), dashboardBody)
+        except Exception as e:
+            logger.warning("Cache dashboard %s error: %s", dashName, e)
+    return True
 # transfer Json object to String, as required by AWS SDK
+# metric lines are written back with "." / "..." shorthand and the json is compact, so the body stays small
 def createDashboardBody(widgets) -> str:
-    dashboardBodyDict = {'widgets': widgets}
-    dashboardBody = json.dumps(dashboardBodyDict)
+    with runMetrics.stage('serialize'):
+        encodedWidgets = []
+        for widgetDict in widgets:
+            properties = widgetDict.get('properties')
+            if properties is not None and 'metrics' in properties:
+                properties = dict(properties)
+                properties['metrics'] = compressMetricLines(properties['metrics'])
+                widgetDict = dict(widgetDict)
+                widgetDict['properties'] = properties
+            encodedWidgets.append(widgetDict)
+        dashboardBodyDict = {'widgets': encodedWidgets}
+        dashboardBody = json.dumps(dashboardBodyDict, separators=COMPACT_SEPARATORS)
     return dashboardBody
 
-# match metric(like CPUUtilization) to remove old metricDict from Widgets
-def matchMetricWidgetInWidgets(curWidgets: List, srvSKU: str, metricName: str):
-    matchId = None
-    for i in range(len(curWidgets)):
-        properties = curWidgets[i].get('properties')
-        metrics = properties.get('metrics')
-        for j in range(len(metrics)):
-            metricElementList = metrics[j]
-            # judge whether srvSKU(metricElementList[0]) is like 'AWS/RDS'
-            res = re.search('^[a-zA-Z]', metricElementList[0])
-            if res and metricElementList[0] == srvSKU and metricElementList[1] == metricName :
-                matchId = i
-                return matchId
-    return matchId
-
-# add metrics of instances into WidgetDict
-def addMetricIntoWidgetDict(widgetDict: Dict, srvSKU: str, metricName: str, clusterInstanceList, region: str, lableDetailList, isInit: bool = False) -> Dict:
-    properties = widgetDict.get('properties')
-    metricList = properties.get('metrics')
-    # delete template's metric from widgetDict when init a new dashboard
-    if isInit:
-        metricList = []
-    #labelRegionMap =  {"region": region, "period": 60}
-    widgetPeriod = properties.get("period")
-    repeatNum = 0
-    for i in range(len(clusterInstanceList)):
-        labelRegionMap = {}
-        labelRegionMap =  {"region": region, "period": widgetPeriod}
-        metricElement = []
-        instanceMap = clusterInstanceList[i]
-        clusterId =  instanceMap['DBClusterIdentifier']
-        instanceId = instanceMap['DBInstanceIdentifier']
-        role = instanceMap['Role']
-        #not repeat to add 
-        if findDuplicateMetric(lableDetailList, metricName, clusterId, instanceId, role, region):
-            repeatNum = repeatNum + 1
+# split a metric line into its items and its option map like {"region": "ap-northeast-1"}, the option map is None when absent
+def splitMetricLine(metricElementList: List):
+    if len(metricElementList) > 0 and isinstance(metricElementList[-1], dict):
+        return list(metricElementList[:-1]), metricElementList[-1]
+    return list(metricElementList), None
+
+def joinMetricLine(items: List, labelRegionMap) -> List:
+    return items + [labelRegionMap] if labelRegionMap is not None else items
+
+'''
+    expand CloudWatch's shorthand of metric lines like ["...", "READER", ".", ".", {"period": 60}]
+    "." repeats the item of the previous line at the same place, "..." repeats the items of the previous line
+    until the rest of the line lines up with the end of the previous line. Options are never repeated.
+'''
+def expandMetricLines(metrics: List) -> List:
+    expandedList = []
+    prevItems = None
+    for metricElementList in metrics:
+        items, labelRegionMap = splitMetricLine(metricElementList)
+        # expression line like [{"expression": "SUM(METRICS())"}] has no items to expand
+        if len(items) == 0:
+            expandedList.append(metricElementList)
             continue
-        metricElement.append(srvSKU)
-        metricElement.append(metricName)
-        metricElement.append("Role")
-        # role in clusterInstanceList to be added monitor
-        metricElement.append(role)
-        # DBClusterIdentifier in clusterInstanceList to be added monitor
-        metricElement.append("DBClusterIdentifier")
-        metricElement.append(clusterId)
-        # { "region": "ap-northeast-1", "label": "SelectLatency - cluster - writer" } 
-        labelRegionMap['label'] = instanceId + '-' + role
-        metricElement.append(labelRegionMap)
-        metricList.append(metricElement)
-    properties['metrics'] = metricList
-    widgetDict['properties'] = properties
-    print("Instance amount of Cluster is: %d, %d instances's metric %s be not added because duplicate! " % (len(clusterInstanceList), repeatNum, metricName) )
-    return widgetDict 
-
-# check whether the instance's metric has been added into monitor, not to repeat adding.
-def findDuplicateMetric(lableDetailList: List, metricName: str, clusterId: str, instanceId: str, role: str, region: str) -> bool:
-    isDuplicate = False
-    # labelDetail is like: ap-northeast-1-CPUUtilization-aurora-2-standard-WRITER
-    labelDetail =  region + '-' + metricName + '-' + instanceId + '-' +role
-    if labelDetail in lableDetailList:
-        isDuplicate = True
-        return isDuplicate
-    return isDuplicate
-
-# build a label list of an online widget, provide a label list to avoid duplicate metric of one instance
-def buildLabelListFromEachWidget(widgetDict: Dict, metricName: str) -> List:
-    labelList = []
-    properties = widgetDict.get('properties')
-    metrics = properties.get('metrics')
-    for j in range(len(metrics)):
-        metricElementList = metrics[j]
-        labelRegionMap = metricElementList[-1]
-        #print(labelRegionMap)
-        if 'label' not in labelRegionMap:
-            labelKey = 'sample'
+        if prevItems is not None:
+            if "..." in items:
+                k = items.index("...")
+                prefix = items[:k]
+                suffix = items[k + 1:]
+                items = prefix + prevItems[len(prefix):max(len(prefix), len(prevItems) - len(suffix))] + suffix
+            items = [prevItems[j] if item == "." and j < len(prevItems) else item for j, item in enumerate(items)]
+        prevItems = items
+        expandedList.append(joinMetricLine(items, labelRegionMap))
+    return expandedList
+
+# write a metric line with shorthand against the previous line, prevItems is None for the first line
+def compressMetricLine(prevItems, metricElementList: List) -> List:
+    items, labelRegionMap = splitMetricLine(metricElementList)
+    if prevItems is None or len(items) == 0 or len(items) != len(prevItems):
+        return metricElementList
+    sameList = [items[j] == prevItems[j] for j in range(len(items))]
+    k = 0
+    while k < len(items) and sameList[k]:
+        k = k + 1
+    shortItems = ["." if sameList[j] else items[j] for j in range(len(items))]
+    # "..." takes the leading run of repeated items when it saves more than one "."
+    if k >= 2:
+        shortItems = ["..."] + shortItems[k:]
+    return joinMetricLine(shortItems, labelRegionMap)
+
+# write metric lines with "." / "..." shorthand, the reverse of expandMetricLines
+def compressMetricLines(metrics: List) -> List:
+    compressedList = []
+    prevItems = None
+    for metricElementList in metrics:
+        compressedList.append(compressMetricLine(prevItems, metricElementList))
+        items = splitMetricLine(metricElementList)[0]
+        # never use shorthand across an expression line
+        prevItems = items if len(items) > 0 else None
+    return compressedList
+
+# region of a metric line, the line option wins over the widget region
+def metricLineRegion(properties: Dict, metricElementList: List) -> str:
+    labelRegionMap = metricElementList[-1] if isinstance(metricElementList[-1], dict) else {}
+    return labelRegionMap.get('region', properties.get('region'))
+
+# value of a dimension in a metric line like ["AWS/RDS", "CPUUtilization", "Role", "WRITER", "DBClusterIdentifier", "aurora-1", {...}]
+def metricLineDimension(metricElementList: List, dimensionName: str):
+    for j in range(2, len(metricElementList) - 1, 2):
+        if metricElementList[j] == dimensionName:
+            return metricElementList[j + 1]
+    return None
+
+# judge whether metricElementList is a metric like ['AWS/RDS', 'CPUUtilization', ...], not an expression or shorthand
+def isMetricLine(metricElementList: List) -> bool:
+    if len(metricElementList) < 2 or not isinstance(metricElementList[0], str) or not isinstance(metricElementList[1], str):
+        return False
+    return re.search('^[a-zA-Z]', metricElementList[0]) is not None and re.search('^[a-zA-Z]', metricElementList[1]) is not None
+
+# key of a metric line to avoid duplicate metric of one instance: (region, metricName, instanceId, role)
+# the instance only lives in the label like aurora-2-standard-WRITER, lines without label are keyed as 'sample'
+def metricLineKey(properties: Dict, metricElementList: List) -> tuple:
+    labelRegionMap = metricElementList[-1] if isinstance(metricElementList[-1], dict) else {}
+    role = metricLineDimension(metricElementList, 'Role')
+    label = labelRegionMap.get('label', 'sample')
+    instanceId = label
+    if role is not None and label.endswith('-' + role):
+        instanceId = label[:-len(role) - 1]
+    return (metricLineRegion(properties, metricElementList), metricElementList[1], instanceId, role)
+
+# whether a metric line is one buildInstanceMetricLine writes: dimensions Role and DBClusterIdentifier, labelled <instanceId>-<role>
+# lines the user made, like cluster level lines or lines with their own label, are not of an instance
+def isInstanceMetricLine(metricElementList: List) -> bool:
+    if not isMetricLine(metricElementList) or sorted(metricLineDimensionNames(metricElementList)) != ['DBClusterIdentifier', 'Role']:
+        return False
+    labelRegionMap = metricElementList[-1] if isinstance(metricElementList[-1], dict) else {}
+    role = metricLineDimension(metricElementList, 'Role')
+    label = labelRegionMap.get('label', '')
+    return isinstance(role, str) and label.endswith('-' + role) and len(label) > len(role) + 1
+
+# key of the metric line which would be added for an instance
+def instanceLineKey(region: str, metricName: str, instanceMap: Dict) -> tuple:
+    return (region, metricName, instanceMap['DBInstanceIdentifier'], instanceMap['Role'])
+
+# build the metric line of an instance, like ["AWS/RDS", "CPUUtilization", "Role", "WRITER", "DBClusterIdentifier", "aurora-1", {"region": "ap-northeast-1", "label": "aurora-1-instance-1-WRITER"}]
+def buildInstanceMetricLine(srvSKU: str, metricName: str, instanceMap: Dict, region: str, widgetPeriod) -> List:
+    labelRegionMap = {"region": region}
+    if widgetPeriod is not None:
+        labelRegionMap["period"] = widgetPeriod
+    labelRegionMap['label'] = instanceMap['DBInstanceIdentifier'] + '-' + instanceMap['Role']
+    return [srvSKU, metricName, "Role", instanceMap['Role'], "DBClusterIdentifier", instanceMap['DBClusterIdentifier'], labelRegionMap]
+
+# dimension names of a metric line, like ['Role', 'DBClusterIdentifier']
+def metricLineDimensionNames(metricElementList: List) -> List:
+    items = splitMetricLine(metricElementList)[0]
+    return [items[j] for j in range(2, len(items) - 1, 2)]
+
+# judge whether a line is a SEARCH expression line written in search mode, like [{"expression": "SEARCH(...)", "id": "search1", ...}]
+def isSearchLine(metricElementList: List) -> bool:
+    items, labelRegionMap = splitMetricLine(metricElementList)
+    return len(items) == 0 and labelRegionMap is not None and str(labelRegionMap.get('id', '')).startswith(SEARCH_LINE_ID) \
+        and str(labelRegionMap.get('expression', '')).startswith('SEARCH(')
+
+# (namespace, metricName, dimension names) plotted by a SEARCH line, None when the expression is not one written in search mode
+def searchLineMetric(metricElementList: List):
+    res = re.search(r'^SEARCH\(\'\{([^}]*)\} MetricName="([^"]+)"', metricElementList[-1]['expression'])
+    if res is None:
+        return None
+    schema = res.group(1).split(',')
+    return schema[0], res.group(2), schema[1:]
+
+# cluster ids selected one by one by a SEARCH line, they are quoted for an exact match, a token term is not
+def searchLineSelection(metricElementList: List) -> List:
+    return re.findall(r'DBClusterIdentifier="([^"]+)"', metricElementList[-1]['expression'])
+
+# whether SEARCH matches the cluster id by the unquoted term DBClusterIdentifier=<token>, it matches whole tokens between punctuation
+def searchTokenMatched(clusterId: str, token: str) -> bool:
+    return token in re.split('[^A-Za-z0-9]+', clusterId)
+
+'''
+    build the SEARCH expression lines of a metric for the clusters of one region, like
+    [{"expression": "SEARCH('{AWS/RDS,DBClusterIdentifier,Role} MetricName=\"CPUUtilization\" (DBClusterIdentifier=\"aurora-1\" OR DBClusterIdentifier=\"aurora-2\")', 'Average', 60)", "id": "search", "region": "ap-northeast-1", "label": "..."}]
+    token selects with one unquoted term all clusters of the region which have it, the cluster ids are split into as few queries as fit SEARCH_MAX_QUERY_LENGTH
+    the ids are numbered by the widget
+'''
+def buildSearchMetricLines(namespace: str, metricName: str, dimensionNames: List, region: str, clusterIds: List, token: str, stat: str, period: int, label: str) -> List:
+    head = '{%s} MetricName="%s"' % (",".join([namespace] + sorted(dimensionNames)), metricName)
+    terms = ['DBClusterIdentifier=%s' % token] if token is not None else []
+    terms = terms + ['DBClusterIdentifier="%s"' % clusterId for clusterId in sorted(clusterIds)]
+    queryTermsList = []
+    queryLength = 0
+    for term in terms:
+        if len(queryTermsList) > 0 and queryLength + len(' OR ') + len(term) <= SEARCH_MAX_QUERY_LENGTH:
+            queryTermsList[-1].append(term)
+            queryLength = queryLength + len(' OR ') + len(term)
         else:
-            labelKey = labelRegionMap.get('label')
-        if 'region' not in labelRegionMap:
-            labelRegionMap['region'] = properties.get('region')
-        labelDetail = labelRegionMap.get('region') + '-' + metricName + '-' + labelKey
-        if labelDetail not in labelList:
-            labelList.append(labelDetail)
-    return labelList
-
-# build a label list of online widgets of dashboard
-def buildAllLabelList(onlineWidgets: List, metricName: str) -> List:
-    labelList = []
-    for i in range(len(onlineWidgets)):
-        properties = onlineWidgets[i].get('properties')
-        metrics = properties.get('metrics')
-        for j in range(len(metrics)):
-            metricElementList = metrics[j]
-            labelRegionMap = metricElementList[-1]
-            #print(labelRegionMap)
-            labelDetail = labelRegionMap.get('region') + '-' + metricName + '-' + labelRegionMap.get('label')
-            if labelDetail not in labelList:
-                labelList.append(labelDetail)
-    return labelList
-
-# build a widget(Metric) list of online widgets of dashboard template
-def buildAllMetricList(onlineWidgets: List, srvSKU: str) -> List:
-    metricList = []
-    for i in range(len(onlineWidgets)):
-        properties = onlineWidgets[i].get('properties')
-        metrics = properties.get('metrics')
-        for j in range(len(metrics)):
-            metricElementList = metrics[j]
-            # judge whether srvSKU(metricElementList[1]) is like 'CPUUtilization\SelectLatency'
-            # print(metricElementList)
-            res = re.search('^[a-zA-Z]', metricElementList[1])
-            if res and metricElementList[0] == srvSKU:
-                metricName = metricElementList[1]
-                if metricName not in metricList:
-                    metricList.append(metricName)
-    return metricList
-
-'''
-    Parameters detail
-    clusterInstanceList: it's a list to be monitored and added into Widgets, element is a dict {'Role': 'WRITER', 'DBClusterIdentifier': 'aurora-1'}
-'''
-def updateWidgetJson(curWidgets: List, srvSKU: str, metricName: str, clusterInstanceList, region: str, isInit: bool = False) -> List:
-    machtchedWidgetId = matchMetricWidgetInWidgets(curWidgets, srvSKU, metricName)
-    if machtchedWidgetId is None:
-        print("Widget not found for this metric: %s", metricName)
-    else:
-        oldWidgetDict = curWidgets[machtchedWidgetId]
-        del curWidgets[machtchedWidgetId]
-        #print(curWidgets)
-        #build all metric label list of oldWidgetDict
-        labelDetailList = buildLabelListFromEachWidget(oldWidgetDict, metricName)
-        newWidgetDict = addMetricIntoWidgetDict(oldWidgetDict, srvSKU, metricName, clusterInstanceList, region, labelDetailList, isInit)
-        #whether del template metric from local json dashboard
-        curWidgets.append(newWidgetDict)
-    return curWidgets
-
-# check tag(RG:pre) exists in RDS cluster TagPair like {'Key': 'RG', 'Value': 'pre'}
-def tagMatched(tagInput: str, tagPair: Dict) -> bool:
-    matched = False
-    tags = tagInput.split(":",1)
-    key = tags[0]
-    value = tags[1]
-    if key == tagPair.get("Key") and value == tagPair.get("Value"):
-        matched = True
-    return matched
+            queryTermsList.append([term])
+            queryLength = len(head) + len(' ()') + len(term)
+    metricLines = []
+    for queryTerms in queryTermsList:
+        query = "%s (%s)" % (head, " OR ".join(queryTerms))
+        metricLines.append([{"expression": "SEARCH('%s', '%s', %d)" % (query, stat, period), "id": SEARCH_LINE_ID, "region": region, "label": label}])
+    return metricLines
+
+# height of a graph widget of width columns which shows the legend of lineNum lines
+def widgetHeight(lineNum: int, width: int) -> int:
+    labelsPerLine = max(1, width // LEGEND_LABEL_COLUMNS)
+    legendLines = -(-lineNum // labelsPerLine)
+    height = WIDGET_GRAPH_HEIGHT + -(-legendLines // WIDGET_LEGEND_LINES_PER_ROW)
+    return max(WIDGET_DEFAULT_SIZE, min(WIDGET_MAX_HEIGHT, height))
+
+'''
+    Occupancy of the 24 columns grid of a dashboard, a bit mask of the columns taken in each row
+    widgets are never moved, a new widget takes the first free slot reading top to bottom and left to right
+    cells are only ever taken, so a row where a size found no slot never has one later: the search for each size
+    starts where the last one of that size ended, and placing the widgets of a dashboard is linear in its rows
+    for each size of widget, whatever gaps the rows keep
+'''
+class GridLayout:
+    def __init__(self):
+        self.rowMasks = []
+        # rows above it are full
+        self.openRow = 0
+        # (width, height) -> first row which may still have a slot of that size
+        self.cursorMap = {}
+
+    def isFree(self, x: int, y: int, width: int, height: int) -> bool:
+        mask = ((1 << width) - 1) << x
+        for row in range(y, min(y + height, len(self.rowMasks))):
+            if self.rowMasks[row] & mask:
+                return False
+        return True
+
+    def occupy(self, x: int, y: int, width: int, height: int):
+        mask = ((1 << width) - 1) << x
+        if y + height > len(self.rowMasks):
+            self.rowMasks.extend([0] * (y + height - len(self.rowMasks)))
+        for row in range(y, y + height):
+            self.rowMasks[row] = self.rowMasks[row] | mask
+        fullMask = (1 << GRID_COLUMNS) - 1
+        while self.openRow < len(self.rowMasks) and self.rowMasks[self.openRow] & fullMask == fullMask:
+            self.openRow = self.openRow + 1
+
+    # take the first free slot of width x height, return its (x, y)
+    def place(self, width: int, height: int) -> tuple:
+        width = max(1, min(width, GRID_COLUMNS))
+        y = max(self.openRow, self.cursorMap.get((width, height), 0))
+        while True:
+            for x in range(GRID_COLUMNS - width + 1):
+                if self.isFree(x, y, width, height):
+                    self.occupy(x, y, width, height)
+                    self.cursorMap[(width, height)] = y
+                    return x, y
+            y = y + 1
+
+    # grow a placed widget into the free rows right below it, up to height, return its new height
+    def grow(self, x: int, y: int, width: int, oldHeight: int, height: int) -> int:
+        newHeight = oldHeight
+        while newHeight < height and self.isFree(x, y + newHeight, width, 1):
+            newHeight = newHeight + 1
+        if newHeight > oldHeight:
+            self.occupy(x, y + oldHeight, width, newHeight - oldHeight)
+        return newHeight
+
+'''
+    Dashboard model: parse the widgets once and index them, so adding N instances across M metrics is O(N*M)
+    metricWidgetMap: (namespace, metricName) -> indexes of the widgets which plot the metric, the first one is the template widget
+    lineKeySet: metricLineKey of every metric line in the dashboard, constant time duplicate check
+    maxMetricsPerWidget: metric line budget of one widget, None means no limit
+    splitWidgets: when a widget is full, repeat it as a new widget instead of going over the budget
+    metricSchemaMap: (namespace, metricName) -> dimension names the dashboard plots the metric by
+    searchMetricSet: metric names plotted by SEARCH expressions in search mode, they get no static lines
+    repeatWidgetMap: index of a widget -> indexes of the widgets repeatWidget made of it, only they are ever deleted
+    repeatOriginMap: index of a repeated widget -> index of the widget it repeats
+    plan: the TemplatePlan the widgets are rendered from, its index is taken instead of indexing the widgets again
+'''
+class DashboardModel:
+    def __init__(self, widgets: List, srvSKU: str, maxMetricsPerWidget: int = None, splitWidgets: bool = False, plan: 'TemplatePlan' = None):
+        self.widgets = widgets
+        self.srvSKU = srvSKU
+        self.maxMetricsPerWidget = maxMetricsPerWidget
+        self.splitWidgets = splitWidgets
+        self.metricWidgetMap = {}
+        self.metricSchemaMap = {}
+        self.searchMetricSet = set()
+        self.repeatWidgetMap = {}
+        self.repeatOriginMap = {}
+        self.lineKeySet = set()
+        self.bodyBytes = 0
+        if plan is not None:
+            self.metricWidgetMap = {metricKey: list(widgetIds) for metricKey, widgetIds in plan.metricWidgetMap.items()}
+            self.repeatWidgetMap = {widgetId: list(repeatIds) for widgetId, repeatIds in plan.repeatWidgetMap.items()}
+            self.repeatOriginMap = dict(plan.repeatOriginMap)
+            self.metricSchemaMap = dict(plan.metricSchemaMap)
+            self.lineKeySet = set(plan.lineKeySet)
+            self.bodyBytes = plan.bodyBytes
+            # a dashboard rendered from a template is new, it is always put
+            self.loadedHash = None
+            return
+        self.buildIndex()
+        # content hash of the body as it was loaded, to skip put_dashboard when nothing changed
+        self.loadedHash = self.contentHash()
+
+    def buildIndex(self):
+        with runMetrics.stage('index'):
+            self.metricWidgetMap = {}
+            self.lineKeySet = set()
+            for i in range(len(self.widgets)):
+                properties = self.widgets[i].get('properties', {})
+                # the model works on expanded lines, shorthand is written back by createDashboardBody
+                if 'metrics' in properties:
+                    properties['metrics'] = expandMetricLines(properties['metrics'])
+                for metricElementList in properties.get('metrics', []):
+                    if isSearchLine(metricElementList) and searchLineMetric(metricElementList) is not None:
+                        namespace, metricName, dimensionNames = searchLineMetric(metricElementList)
+                        metricKey = (namespace, metricName)
+                    elif isMetricLine(metricElementList):
+                        metricKey = (metricElementList[0], metricElementList[1])
+                        dimensionNames = metricLineDimensionNames(metricElementList)
+                        self.lineKeySet.add(metricLineKey(properties, metricElementList))
+                    else:
+                        continue
+                    widgetIds = self.metricWidgetMap.setdefault(metricKey, [])
+                    if i not in widgetIds:
+                        widgetIds.append(i)
+                    self.metricSchemaMap.setdefault(metricKey, dimensionNames)
+            self.indexRepeats()
+            self.bodyBytes = len(self.toBody())
+
+    '''
+        find the widgets repeatWidget made in former runs by their title "<title of the origin> (2)" alone,
+        the lines of a widget don't tell, an origin which plots many metrics may be filled with the lines of one of them
+    '''
+    def indexRepeats(self):
+        self.repeatWidgetMap = {}
+        self.repeatOriginMap = {}
+        originIdMap = {}
+        for i in range(len(self.widgets)):
+            title = self.widgets[i].get('properties', {}).get('title')
+            if title is None:
+                continue
+            res = re.search(r'^(.*) \((\d+)\)$', title)
+            originId = originIdMap.get(res.group(1)) if res else None
+            if originId is not None:
+                self.repeatWidgetMap.setdefault(originId, []).append(i)
+                self.repeatOriginMap[i] = originId
+            else:
+                originIdMap.setdefault(title, i)
+
+    # metric names of srvSKU(like 'AWS/RDS') plotted in the dashboard by static lines, in widget order
+    def metricNames(self) -> List:
+        return [metricKey[1] for metricKey in self.metricWidgetMap if metricKey[0] == self.srvSKU and metricKey[1] not in self.searchMetricSet]
+
+    # plot by SEARCH expressions the metrics of srvSKU plotted by DBClusterIdentifier, return the metric names falling back to static lines
+    def useSearch(self) -> List:
+        self.searchMetricSet = {metricKey[1] for metricKey, dimensionNames in self.metricSchemaMap.items()
+                                if metricKey[0] == self.srvSKU and 'DBClusterIdentifier' in dimensionNames}
+        return self.metricNames()
+
+    '''
+        rewrite the widgets of the SEARCH metrics with SEARCH expressions selecting the clusters of regionClusterMap {region: set of clusterIds}
+        merge: keep the clusters the widgets select one by one already, by SEARCH expressions or by static lines which are replaced, update merges and sync doesn't
+        searchToken: clusters which have the token are selected by it instead of one by one, a token of the dashboard is kept only when it is passed again
+        return the number of SEARCH expression lines
+    '''
+    def applySearch(self, regionClusterMap: Dict, searchToken: str = None, merge: bool = True) -> int:
+        selectionMap = {region: set(clusterIds) for region, clusterIds in regionClusterMap.items()}
+        searchWidgetIds = sorted({widgetIds[0] for metricKey, widgetIds in self.metricWidgetMap.items()
+                                  if metricKey[0] == self.srvSKU and metricKey[1] in self.searchMetricSet})
+        for widgetId in searchWidgetIds:
+            properties = self.widgets[widgetId]['properties']
+            keptList = []
+            for metricElementList in properties.get('metrics', []):
+                if isSearchLine(metricElementList):
+                    region = metricElementList[-1].get('region', properties.get('region'))
+                    if merge and region is not None:
+                        selectionMap.setdefault(region, set()).update(searchLineSelection(metricElementList))
+                    continue
+                if isMetricLine(metricElementList) and metricElementList[0] == self.srvSKU and metricElementList[1] in self.searchMetricSet:
+                    clusterId = metricLineDimension(metricElementList, 'DBClusterIdentifier')
+                    region = metricLineRegion(properties, metricElementList)
+                    if clusterId is not None:
+                        if merge and region is not None:
+                            selectionMap.setdefault(region, set()).add(clusterId)
+                        continue
+                keptList.append(metricElementList)
+            properties['metrics'] = keptList
+        searchNum = 0
+        for widgetId in searchWidgetIds:
+            properties = self.widgets[widgetId]['properties']
+            metricKeys = [metricKey for metricKey, widgetIds in self.metricWidgetMap.items()
+                          if metricKey[0] == self.srvSKU and metricKey[1] in self.searchMetricSet and widgetIds[0] == widgetId]
+            for metricKey in metricKeys:
+                dimensionNames = self.metricSchemaMap[metricKey]
+                # dynamic label like aurora-1-WRITER, with the metric name when the widget plots many metrics
+                label = "-".join("${PROP('Dim.%s')}" % dimensionName for dimensionName in ['DBClusterIdentifier'] + [d for d in dimensionNames if d != 'DBClusterIdentifier'])
+                if len(metricKeys) > 1:
+                    label = "${PROP('MetricName')} " + label
+                for region in sorted(selectionMap):
+                    # the token is taken in a region only when clusters selected there have it
+                    token = None
+                    if searchToken is not None and any(searchTokenMatched(clusterId, searchToken) for clusterId in selectionMap[region]):
+                        token = searchToken
+                    clusterIds = [clusterId for clusterId in selectionMap[region] if token is None or not searchTokenMatched(clusterId, token)]
+                    if token is None and len(clusterIds) == 0:
+                        continue
+                    metricLines = buildSearchMetricLines(metricKey[0], metricKey[1], dimensionNames, region, clusterIds, token,
+                                                         properties.get('stat', 'Average'), properties.get('period', 300), label)
+                    properties['metrics'].extend(metricLines)
+                    searchNum = searchNum + len(metricLines)
+            # ids are unique in a widget and start with a lowercase letter
+            k = 0
+            for metricElementList in properties['metrics']:
+                if isSearchLine(metricElementList):
+                    k = k + 1
+                    metricElementList[-1]['id'] = "%s%d" % (SEARCH_LINE_ID, k)
+        self.lineKeySet = set()
+        for widgetDict in self.widgets:
+            properties = widgetDict.get('properties', {})
+            for metricElementList in properties.get('metrics', []):
+                if isMetricLine(metricElementList):
+                    self.lineKeySet.add(metricLineKey(properties, metricElementList))
+        self.bodyBytes = len(self.toBody())
+        return searchNum
+
+    # delete template's metric from the widgets of srvSKU when init a new dashboard, the widgets stay indexed
+    def clearMetricLines(self):
+        for metricKey, widgetIds in self.metricWidgetMap.items():
+            if metricKey[0] == self.srvSKU:
+                for widgetId in widgetIds:
+                    self.widgets[widgetId]['properties']['metrics'] = []
+        self.lineKeySet = set()
+        for i in range(len(self.widgets)):
+            properties = self.widgets[i].get('properties', {})
+            for metricElementList in properties.get('metrics', []):
+                if isMetricLine(metricElementList):
+                    self.lineKeySet.add(metricLineKey(properties, metricElementList))
+        self.bodyBytes = len(self.toBody())
+
+    # whether the metric lines of instances fit into the widget budget and the body budget, lines in rejectedLineKeySet are not added
+    def canAddInstances(self, clusterInstanceList: List, region: str, maxBodyBytes: int = None, rejectedLineKeySet: set = None) -> bool:
+        addBytes = 0
+        # metric lines to add into each widget group, widgets which plot many metrics take the lines of all of them
+        addNumMap = {}
+        for metricName in self.metricNames():
+            widgetIds = self.widgetChain(metricName)
+            properties = self.widgets[widgetIds[-1]]['properties']
+            prevElementList = properties['metrics'][-1] if len(properties['metrics']) > 0 else None
+            for instanceMap in clusterInstanceList:
+                lineKey = instanceLineKey(region, metricName, instanceMap)
+                if lineKey in self.lineKeySet or (rejectedLineKeySet is not None and lineKey in rejectedLineKeySet):
+                    continue
+                addNumMap[tuple(widgetIds)] = addNumMap.get(tuple(widgetIds), 0) + 1
+                metricElementList = buildInstanceMetricLine(self.srvSKU, metricName, instanceMap, region, properties.get("period"))
+                addBytes = addBytes + metricLineBytes(prevElementList, metricElementList)
+                prevElementList = metricElementList
+        if self.maxMetricsPerWidget is not None and not self.splitWidgets:
+            for widgetIds, addNum in addNumMap.items():
+                freeNum = sum(self.maxMetricsPerWidget - len(self.widgets[widgetId]['properties']['metrics']) for widgetId in widgetIds)
+                if addNum > freeNum:
+                    return False
+        return maxBodyBytes is None or self.bodyBytes + addBytes <= maxBodyBytes
+
+    # the template widget of the metric and its repeats, other widgets of the user which plot the metric never take new lines
+    def widgetChain(self, metricName: str) -> List:
+        widgetId = self.metricWidgetMap[(self.srvSKU, metricName)][0]
+        # the lines of the metric may all be on repeats, the chain starts from their origin
+        widgetId = self.repeatOriginMap.get(widgetId, widgetId)
+        return [widgetId] + self.repeatWidgetMap.get(widgetId, [])
+
+    # widget of the metric which still has room for one more line, repeat the widget when all of them are full and splitWidgets
+    def widgetWithRoom(self, metricName: str) -> int:
+        widgetIds = self.widgetChain(metricName)
+        if self.maxMetricsPerWidget is None:
+            return widgetIds[0]
+        for widgetId in widgetIds:
+            if len(self.widgets[widgetId]['properties']['metrics']) < self.maxMetricsPerWidget:
+                return widgetId
+        if not self.splitWidgets:
+            return widgetIds[0]
+        return self.repeatWidget(widgetIds[0])
+
+    # repeat a widget without its metric lines, the new widget joins all metrics of the origin widget
+    # x/y are dropped, layoutWidgets puts the widget into the first free slot of the dashboard
+    # the repeat is titled "<title of the origin> (n)" with n after the highest of the chain, an origin without title is titled by its metrics
+    def repeatWidget(self, widgetId: int) -> int:
+        oldWidgetDict = self.widgets[widgetId]
+        if oldWidgetDict['properties'].get('title') is None:
+            metricNames = [metricKey[1] for metricKey, widgetIds in self.metricWidgetMap.items() if metricKey[0] == self.srvSKU and widgetId in widgetIds]
+            oldWidgetDict['properties']['title'] = ", ".join(sorted(metricNames))
+            self.bodyBytes = self.bodyBytes + len(json.dumps({'title': oldWidgetDict['properties']['title']}, separators=COMPACT_SEPARATORS))
+        repeatIds = self.repeatWidgetMap.setdefault(widgetId, [])
+        repeatNum = 1
+        for repeatId in repeatIds:
+            res = re.search(r' \((\d+)\)$', self.widgets[repeatId]['properties']['title'])
+            repeatNum = max(repeatNum, int(res.group(1)))
+        newWidgetDict = {k: v for k, v in oldWidgetDict.items() if k not in ('x', 'y', 'properties')}
+        properties = dict(oldWidgetDict['properties'])
+        properties['metrics'] = []
+        newWidgetId = len(self.widgets)
+        for metricKey, widgetIds in self.metricWidgetMap.items():
+            if widgetId in widgetIds:
+                widgetIds.append(newWidgetId)
+        # the title finds the repeat again when the dashboard is loaded
+        properties['title'] = "%s (%d)" % (properties['title'], repeatNum + 1)
+        repeatIds.append(newWidgetId)
+        self.repeatOriginMap[newWidgetId] = widgetId
+        newWidgetDict['properties'] = properties
+        self.widgets.append(newWidgetDict)
+        self.bodyBytes = self.bodyBytes + len(json.dumps(newWidgetDict, separators=COMPACT_SEPARATORS)) + 1
+        logger.info("Widget %s is full, repeat it as a new widget.", oldWidgetDict['properties'].get('title'))
+        return newWidgetId
+
+    '''
+        add metrics of instances into the widget of each metric, widgets keep their place in the dashboard
+        clusterInstanceList: element is a dict {'Role': 'WRITER', 'DBClusterIdentifier': 'aurora-1', 'DBInstanceIdentifier': 'aurora-1-primary'}
+        rejectedLineKeySet: instanceLineKey of the lines not to add, like the instances out of the top N of a metric
+    '''
+    def addInstances(self, clusterInstanceList: List, region: str, quiet: bool = False, rejectedLineKeySet: set = None) -> int:
+        addedNum = 0
+        rejectedNum = 0
+        for metricName in self.metricNames():
+            repeatNum = 0
+            for i in range(len(clusterInstanceList)):
+                instanceMap = clusterInstanceList[i]
+                lineKey = instanceLineKey(region, metricName, instanceMap)
+                #not repeat to add
+                if lineKey in self.lineKeySet:
+                    repeatNum = repeatNum + 1
+                    continue
+                if rejectedLineKeySet is not None and lineKey in rejectedLineKeySet:
+                    rejectedNum = rejectedNum + 1
+                    continue
+                properties = self.widgets[self.widgetWithRoom(metricName)]['properties']
+                metricList = properties['metrics']
+                metricElementList = buildInstanceMetricLine(self.srvSKU, metricName, instanceMap, region, properties.get("period"))
+                self.bodyBytes = self.bodyBytes + metricLineBytes(metricList[-1] if len(metricList) > 0 else None, metricElementList)
+                metricList.append(metricElementList)
+                self.lineKeySet.add(lineKey)
+                addedNum = addedNum + 1
+            runMetrics.count('metric_lines_skipped_total', repeatNum, reason='duplicate')
+            if not quiet:
+                logger.info("Instance amount of Cluster is: %d, %d instances's metric %s be not added because duplicate! ", len(clusterInstanceList), repeatNum, metricName)
+        runMetrics.count('metric_lines_added_total', addedNum)
+        runMetrics.count('metric_lines_skipped_total', rejectedNum, reason='not_top')
+        return addedNum
+
+    '''
+        delete metric lines of srvSKU whose instance is not in desiredInstanceSet, for sync mode, or whose key is in rejectedLineKeySet
+        only the instance lines this tool writes are deleted, and only from the widget chain of each metric, other lines and widgets are the user's
+        desiredInstanceSet: element is (region, instanceId, role) of a discovered instance, None keeps every instance
+        rejectedLineKeySet: element is metricLineKey (region, metricName, instanceId, role) of a line to delete
+        repeated widgets which are left without any metric line are deleted too
+    '''
+    def pruneInstances(self, desiredInstanceSet: set = None, rejectedLineKeySet: set = None) -> int:
+        # only the widgets repeatWidget made are deleted when they are left empty, the widgets of the user always stay
+        repeatedWidgetIds = {repeatId for repeatIds in self.repeatWidgetMap.values() for repeatId in repeatIds}
+        metricNameSet = set(self.metricNames())
+        chainWidgetIdSet = {widgetId for metricName in metricNameSet for widgetId in self.widgetChain(metricName)}
+        removedNum = 0
+        keptWidgets = []
+        for i in range(len(self.widgets)):
+            properties = self.widgets[i].get('properties', {})
+            metricList = properties.get('metrics', [])
+            if i not in chainWidgetIdSet:
+                keptWidgets.append(self.widgets[i])
+                continue
+            keptList = []
+            for metricElementList in metricList:
+                if isInstanceMetricLine(metricElementList) and metricElementList[0] == self.srvSKU and metricElementList[1] in metricNameSet:
+                    lineKey = metricLineKey(properties, metricElementList)
+                    if (desiredInstanceSet is not None and (lineKey[0], lineKey[2], lineKey[3]) not in desiredInstanceSet) \
+                            or (rejectedLineKeySet is not None and lineKey in rejectedLineKeySet):
+                        removedNum = removedNum + 1
+                        continue
+                keptList.append(metricElementList)
+            if len(keptList) == 0 and len(metricList) > 0 and i in repeatedWidgetIds:
+                continue
+            if len(keptList) != len(metricList):
+                properties['metrics'] = keptList
+            keptWidgets.append(self.widgets[i])
+        if removedNum > 0:
+            # widgets keep their metrics even when they are left without metric lines, so the index is remapped instead of rebuilt
+            newWidgetIdMap = {id(keptWidgets[i]): i for i in range(len(keptWidgets))}
+            oldWidgetIds = [newWidgetIdMap.get(id(widgetDict)) for widgetDict in self.widgets]
+            for metricKey, widgetIds in self.metricWidgetMap.items():
+                widgetIds[:] = [oldWidgetIds[widgetId] for widgetId in widgetIds if oldWidgetIds[widgetId] is not None]
+            self.repeatWidgetMap = {oldWidgetIds[widgetId]: [oldWidgetIds[repeatId] for repeatId in repeatIds if oldWidgetIds[repeatId] is not None]
+                                    for widgetId, repeatIds in self.repeatWidgetMap.items()}
+            self.repeatOriginMap = {repeatId: widgetId for widgetId, repeatIds in self.repeatWidgetMap.items() for repeatId in repeatIds}
+            self.widgets[:] = keptWidgets
+            self.lineKeySet = set()
+            for widgetDict in self.widgets:
+                properties = widgetDict.get('properties', {})
+                for metricElementList in properties.get('metrics', []):
+                    if isMetricLine(metricElementList):
+                        self.lineKeySet.add(metricLineKey(properties, metricElementList))
+            self.bodyBytes = len(self.toBody())
+        runMetrics.count('metric_lines_deleted_total', removedNum)
+        return removedNum
+
+    '''
+        lay the widgets out on the grid before the dashboard is put, widgets which have a place keep it
+        the widgets of srvSKU grow into the free rows below them as their legend needs, they never shrink
+        widgets without a place, like the repeated ones, take the first free slot with the height of their lines
+        return the number of widgets placed or resized
+    '''
+    def layoutWidgets(self) -> int:
+        grid = GridLayout()
+        managedIdSet = {widgetId for metricKey, widgetIds in self.metricWidgetMap.items() if metricKey[0] == self.srvSKU for widgetId in widgetIds}
+        unplacedIds = []
+        for i in range(len(self.widgets)):
+            widgetDict = self.widgets[i]
+            if 'x' in widgetDict and 'y' in widgetDict:
+                grid.occupy(widgetDict['x'], widgetDict['y'], widgetDict.get('width', WIDGET_DEFAULT_SIZE), widgetDict.get('height', WIDGET_DEFAULT_SIZE))
+            else:
+                unplacedIds.append(i)
+        resizedNum = 0
+        for widgetId in sorted(managedIdSet.difference(unplacedIds)):
+            widgetDict = self.widgets[widgetId]
+            width = widgetDict.get('width', WIDGET_DEFAULT_SIZE)
+            oldHeight = widgetDict.get('height', WIDGET_DEFAULT_SIZE)
+            height = widgetHeight(len(widgetDict['properties'].get('metrics', [])), width)
+            if height > oldHeight:
+                height = grid.grow(widgetDict['x'], widgetDict['y'], width, oldHeight, height)
+                if height > oldHeight:
+                    widgetDict['height'] = height
+                    resizedNum = resizedNum + 1
+        for widgetId in unplacedIds:
+            widgetDict = self.widgets[widgetId]
+            width = max(1, min(widgetDict.get('width', WIDGET_DEFAULT_SIZE), GRID_COLUMNS))
+            height = widgetDict.get('height', WIDGET_DEFAULT_SIZE)
+            if widgetId in managedIdSet:
+                height = widgetHeight(len(widgetDict['properties'].get('metrics', [])), width)
+            widgetDict['x'], widgetDict['y'] = grid.place(width, height)
+            widgetDict['width'] = width
+            widgetDict['height'] = height
+        runMetrics.count('widgets_placed_total', len(unplacedIds))
+        runMetrics.count('widgets_resized_total', resizedNum)
+        if len(unplacedIds) + resizedNum > 0:
+            self.bodyBytes = len(self.toBody())
+        return len(unplacedIds) + resizedNum
+
+    # hash of the canonical body, lines expanded and keys sorted, so shorthand or key order doesn't count as a change
+    def contentHash(self) -> str:
+        return hashlib.sha256(json.dumps(self.widgets, sort_keys=True, separators=COMPACT_SEPARATORS).encode('utf-8')).hexdigest()
+
+    def isChanged(self) -> bool:
+        return self.contentHash() != self.loadedHash
+
+    # transfer the model to the dashboard body String, as required by AWS SDK
+    def toBody(self) -> str:
+        return createDashboardBody(self.widgets)
+
+'''
+    Template compiled once: the widgets parsed with the metric lines of srvSKU cleared, and the index of the model over them
+    the plan is never changed, render() gives each dashboard its own widgets in one pass, the widgets and their properties
+    are copied shallowly and only the metric lists are new, the model fills them with the lines of its instances
+'''
+class TemplatePlan:
+    def __init__(self, templateBody: str, srvSKU: str):
+        model = DashboardModel(json.loads(templateBody), srvSKU)
+        model.clearMetricLines()
+        self.srvSKU = srvSKU
+        self.widgets = tuple(model.widgets)
+        self.metricWidgetMap = {metricKey: tuple(widgetIds) for metricKey, widgetIds in model.metricWidgetMap.items()}
+        self.metricSchemaMap = {metricKey: tuple(dimensionNames) for metricKey, dimensionNames in model.metricSchemaMap.items()}
+        self.repeatWidgetMap = {widgetId: tuple(repeatIds) for widgetId, repeatIds in model.repeatWidgetMap.items()}
+        self.repeatOriginMap = dict(model.repeatOriginMap)
+        self.lineKeySet = frozenset(model.lineKeySet)
+        self.bodyBytes = model.bodyBytes
+
+    # metric names of srvSKU the template plots, in widget order
+    def metricNames(self) -> List:
+        return [metricKey[1] for metricKey in self.metricWidgetMap if metricKey[0] == self.srvSKU]
+
+    def render(self) -> List:
+        widgets = []
+        for widgetDict in self.widgets:
+            widgetDict = dict(widgetDict)
+            if 'properties' in widgetDict:
+                properties = dict(widgetDict['properties'])
+                if 'metrics' in properties:
+                    properties['metrics'] = list(properties['metrics'])
+                widgetDict['properties'] = properties
+            widgets.append(widgetDict)
+        return widgets
+
+    # a new dashboard model over rendered widgets
+    def newModel(self, maxMetricsPerWidget: int = None, splitWidgets: bool = False) -> DashboardModel:
+        return DashboardModel(self.render(), self.srvSKU, maxMetricsPerWidget, splitWidgets, self)
+
+# compiled templates by (sha256 of the template file, srvSKU), the dashboards of one template in a process compile it once
+templatePlanCache = {}
+templatePlanLock = threading.Lock()
+
+# compiled plan of a local json template, an edited template file is compiled again
+def getTemplatePlan(templateFile: str, srvSKU: str) -> TemplatePlan:
+    with open(templateFile, 'rb') as f:
+        templateBytes = f.read()
+    planKey = (hashlib.sha256(templateBytes).hexdigest(), srvSKU)
+    with templatePlanLock:
+        plan = templatePlanCache.get(planKey)
+    if plan is None:
+        plan = TemplatePlan(templateBytes.decode('utf-8'), srvSKU)
+        runMetrics.count('template_compiles_total')
+        with templatePlanLock:
+            plan = templatePlanCache.setdefault(planKey, plan)
+    return plan
+
+# bytes one more metric line takes in the encoded dashboard body, after the line prevElementList of the same widget
+def metricLineBytes(prevElementList, metricElementList: List) -> int:
+    prevItems = splitMetricLine(prevElementList)[0] if prevElementList is not None else None
+    if prevItems is not None and len(prevItems) == 0:
+        prevItems = None
+    return len(json.dumps(compressMetricLine(prevItems, metricElementList), separators=COMPACT_SEPARATORS)) + 1
+
+'''
+    Numbered dashboards <dashName>-1, <dashName>-2 ... which share the instances of one fleet
+    an instance which is already on a shard stays there, a new instance goes to the open shard, or to a new shard
+    templatePlan: new shards are rendered from it
+    openShardId: index of the first shard which may have room, the shards before it are full until sync deletes lines
+    shardList: element is [dashboard name, DashboardModel]
+'''
+class DashboardShards:
+    def __init__(self, dashName: str, srvSKU: str, templatePlan: TemplatePlan, maxMetricsPerWidget: int, maxBodyBytes: int):
+        self.dashName = dashName
+        self.srvSKU = srvSKU
+        self.templatePlan = templatePlan
+        self.maxMetricsPerWidget = maxMetricsPerWidget
+        self.maxBodyBytes = maxBodyBytes
+        self.shardList = []
+        # (region, instanceId, role) -> index in shardList
+        self.instanceShardMap = {}
+        self.openShardId = 0
+
+    # add an online shard, or a new shard from the template when widgets is None
+    def addShard(self, widgets: List = None) -> DashboardModel:
+        if widgets is None:
+            model = self.templatePlan.newModel(self.maxMetricsPerWidget)
+        else:
+            model = DashboardModel(widgets, self.srvSKU, self.maxMetricsPerWidget)
+        shardId = len(self.shardList)
+        for lineKey in model.lineKeySet:
+            self.instanceShardMap.setdefault((lineKey[0], lineKey[2], lineKey[3]), shardId)
+        self.shardList.append(["%s-%d" % (self.dashName, shardId + 1), model])
+        return model
+
+    # metric names of srvSKU plotted by the template of the shards
+    def metricNames(self) -> List:
+        return self.templatePlan.metricNames()
+
+    # add a page of instances, the page is checked against the open shard at once, and instance by instance when it doesn't fit
+    def addInstances(self, clusterInstanceList: List, region: str, rejectedLineKeySet: set = None) -> int:
+        addedNum = 0
+        shardInstanceMap = {}
+        newInstanceList = []
+        for instanceMap in clusterInstanceList:
+            shardId = self.instanceShardMap.get((region, instanceMap['DBInstanceIdentifier'], instanceMap['Role']))
+            if shardId is None:
+                newInstanceList.append(instanceMap)
+            else:
+                shardInstanceMap.setdefault(shardId, []).append(instanceMap)
+        for shardId, instanceList in shardInstanceMap.items():
+            addedNum = addedNum + self.shardList[shardId][1].addInstances(instanceList, region, True, rejectedLineKeySet)
+        k = 0
+        pageFits = True
+        while k < len(newInstanceList):
+            isNew = self.openShardId >= len(self.shardList)
+            if isNew:
+                if len(self.shardList) > 0:
+                    logger.info("Dashboard shards are full, new shard %s-%d is added.", self.dashName, len(self.shardList) + 1)
+                self.addShard()
+            model = self.shardList[self.openShardId][1]
+            if pageFits and model.canAddInstances(newInstanceList[k:], region, self.maxBodyBytes, rejectedLineKeySet):
+                instanceList = newInstanceList[k:]
+            else:
+                pageFits = False
+                instanceList = newInstanceList[k:k + 1]
+                # a new shard takes the instance even when it doesn't fit, so it can't be passed on for ever
+                if not isNew and not model.canAddInstances(instanceList, region, self.maxBodyBytes, rejectedLineKeySet):
+                    self.openShardId = self.openShardId + 1
+                    pageFits = True
+                    continue
+            for instanceMap in instanceList:
+                self.instanceShardMap[(region, instanceMap['DBInstanceIdentifier'], instanceMap['Role'])] = self.openShardId
+            addedNum = addedNum + model.addInstances(instanceList, region, True, rejectedLineKeySet)
+            k = k + len(instanceList)
+        return addedNum
+
+    # delete metric lines of instances not in desiredInstanceSet or of keys in rejectedLineKeySet from every shard
+    def pruneInstances(self, desiredInstanceSet: set = None, rejectedLineKeySet: set = None) -> int:
+        removedNum = 0
+        for shardName, model in self.shardList:
+            removedNum = removedNum + model.pruneInstances(desiredInstanceSet, rejectedLineKeySet)
+        if removedNum > 0:
+            self.openShardId = 0
+        if desiredInstanceSet is not None:
+            self.instanceShardMap = {instanceKey: shardId for instanceKey, shardId in self.instanceShardMap.items() if instanceKey in desiredInstanceSet}
+        return removedNum
+
+    def layoutWidgets(self) -> int:
+        return sum(model.layoutWidgets() for shardName, model in self.shardList)
+
+    # dashboard name and body of each shard, only the changed shards when changedOnly
+    def toBodies(self, changedOnly: bool = False) -> List:
+        return [(shardName, model.toBody()) for shardName, model in self.shardList if not changedOnly or model.isChanged()]
+
+# names of the numbered dashboards <dashName>-1, <dashName>-2 ... in cloudWatch, in shard order
+def listDashboardShardNames(client, dashName: str, region: str) -> List:
+    shardNumMap = {}
+    for dashboard in listAllDashboards(client, dashName + '-', region):
+        res = re.search('^' + re.escape(dashName) + r'-(\d+)$', dashboard.get("DashboardName"))
+        if res:
+            shardNumMap[int(res.group(1))] = dashboard.get("DashboardName")
+    return [shardNumMap[num] for num in sorted(shardNumMap)]
+
+# put many dashboards at the same time, dashBodies element is (dashboard name, dashboard body), return whether all of them are put
+def updateDashboards(client, dashBodies: List, workers: int = 8) -> bool:
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(dashBodies)))) as executor:
+        return all(executor.map(lambda dashBody: updateDashboard(client, dashBody[0], dashBody[1]), dashBodies))
+
+'''
+    parse a tag selector like "env:prod AND team:payments OR tier:gold", AND binds tighter than OR
+    return the selector as a list of AND groups, [[('env', 'prod'), ('team', 'payments')], [('tier', 'gold')]]
+    raise ValueError when a term is not like key:value
+'''
+def parseTagExpression(tagInput: str) -> List:
+    tagExpression = []
+    for andTerms in re.split(r'\s+OR\s+', tagInput.strip()):
+        tagPairList = []
+        for term in re.split(r'\s+AND\s+', andTerms.strip()):
+            tags = term.strip().split(":",1)
+            if len(tags) < 2 or tags[0] == "":
+                raise ValueError("tag %s is invalid" % term)
+            tagPairList.append((tags[0], tags[1]))
+        tagExpression.append(tagPairList)
+    return tagExpression
+
+# check whether the cluster TagList like [{'Key': 'RG', 'Value': 'pre'}] matches the tag selector of parseTagExpression
+def tagExpressionMatched(tagExpression: List, tagList: List) -> bool:
+    tagMap = {tagPair.get("Key"): tagPair.get("Value") for tagPair in tagList}
+    for tagPairList in tagExpression:
+        if all(key in tagMap and tagMap[key] == value for key, value in tagPairList):
+            return True
+    return False
 
 # dbInstances is the Json in DBClusterMembers, return a list[{"DBInstanceIdentifier":"aurora-test-instance-1","DBClusterIdentifier": "aurora-test","role":"WRITER"}, ]
 def convertClusterInstancesToInstanceList(dbInstances: List, clusterId: str) -> List:
@@ -216,57 +1252,139 @@ def convertClusterInstancesToInstanceList(dbInstances: List, clusterId: str) ->
             instanceList.append(dbInstanceMap)
     return instanceList
 
-# get Aurora Instance list from AWS SDK by clusterID or tag, not for RDS instance!
-def getClusterInstances(client, clusterId: str, region: str, tag: str) -> List:
-    instanceList = []
-    dbclusters = []
-    dbInstances = []
+# describe_db_clusters takes a limited number of values in one db-cluster-id filter, so ids are queried in batches
+CLUSTER_ID_FILTER_BATCH = 100
+
+# split the --clusterId input like cluster1,cluster2,cluster3 into a list of cluster identifiers
+def splitClusterIds(clusterIds: str) -> List:
+    return [clusterId.strip() for clusterId in clusterIds.split(",") if clusterId.strip() != ""]
+
+# page through describe_db_clusters and yield the DBClusters of each page, all clusters of the region when clusterIds is None
+def iterDbClusters(client, clusterIds: List = None):
+    paginator = client.get_paginator('describe_db_clusters')
+    if clusterIds is None:
+        for page in paginator.paginate():
+            yield page['DBClusters']
+        return
+    for k in range(0, len(clusterIds), CLUSTER_ID_FILTER_BATCH):
+        batch = clusterIds[k:k + CLUSTER_ID_FILTER_BATCH]
+        for page in paginator.paginate(Filters=[{'Name': 'db-cluster-id', 'Values': batch}]):
+            yield page['DBClusters']
+
+# ARNs of the DB clusters matching the tag selector from the Resource Groups Tagging API, yields the new ARNs of each page
+# TagFilters of get_resources are ANDed, so each AND group is one query and the ARNs of the groups are merged
+def iterTaggedClusterArns(client, tagExpression: List):
+    seenArnSet = set()
+    paginator = client.get_paginator('get_resources')
+    for tagPairList in tagExpression:
+        tagFilters = [{'Key': key, 'Values': [value]} for key, value in tagPairList]
+        for page in paginator.paginate(ResourceTypeFilters=['rds:cluster'], TagFilters=tagFilters):
+            clusterArnList = []
+            for resourceMap in page.get('ResourceTagMappingList', []):
+                clusterArn = resourceMap.get('ResourceARN')
+                if clusterArn not in seenArnSet:
+                    seenArnSet.add(clusterArn)
+                    clusterArnList.append(clusterArn)
+            if len(clusterArnList) > 0:
+                yield clusterArnList
+
+# instance list of each page of DBClusters
+def iterDbClusterInstances(dbclusterPages):
+    for dbclusters in dbclusterPages:
+        instanceList = []
+        for dbcluster in dbclusters:
+            dbInstances = dbcluster.get("DBClusterMembers", [])
+            instanceList = instanceList + convertClusterInstancesToInstanceList(dbInstances, dbcluster.get("DBClusterIdentifier"))
+        if len(instanceList) > 0:
+            yield instanceList
+
+# clusters matching the tag selector of the region, only the tagged clusters are described
+def iterTaggedDbClusters(client, region: str, tagExpression: List):
+    for clusterArnList in iterTaggedClusterArns(getClient('resourcegroupstaggingapi', region), tagExpression):
+        # the db-cluster-id filter takes ARNs as well as identifiers
+        for dbclusters in iterDbClusters(client, clusterArnList):
+            yield dbclusters
+
+'''
+    get Aurora Instance list from AWS SDK by clusterID(s) or tag selector, not for RDS instance!
+    it is a generator which yields the instance list of each describe_db_clusters page, so callers can update widgets while discovery goes on
+    tagBackend: 'describe' describes every cluster of the region and matches its TagList,
+                'tagging' asks the Resource Groups Tagging API for the matching clusters and describes only them
+    a fresh entry of the discovery cache is yielded as one page instead of calling AWS
+'''
+def getClusterInstances(client, clusterId: str, region: str, tag: str, tagBackend: str = 'describe'):
+    if not discoveryCache.enabled:
+        yield from timedIter('discovery', discoverClusterInstances(client, clusterId, region, tag, tagBackend))
+        return
     if clusterId != None:
-        response = client.describe_db_clusters(
-            DBClusterIdentifier = clusterId,
-            Marker = 'string'
-            )
-        dbclusters = response['DBClusters']
-        dbcluster = dbclusters[0]
-        dbInstances = dbcluster.get("DBClusterMembers")
-        instanceList = convertClusterInstancesToInstanceList(dbInstances, clusterId)
-    elif tag != None:
-        response = client.describe_db_clusters(
-            Marker = 'string'
-            )
-        dbclusters = response['DBClusters']
-        #print(dbclusters)
-        for i in (range(len(dbclusters))):
-            dbcluster = dbclusters[i]
-            tagList = dbcluster.get("TagList")
-            for j in range(len(tagList)):
-                tagPair = tagList[j]
-                if tagMatched(tag, tagPair):
-                    dbInstances = dbcluster.get("DBClusterMembers")
-                    instanceList = instanceList + convertClusterInstancesToInstanceList(dbInstances, dbcluster.get("DBClusterIdentifier"))
-                    break
-    return instanceList
+        cacheKey = ('instances', getAccountId(region), region, 'clusterId', sorted(splitClusterIds(clusterId)))
+    else:
+        cacheKey = ('instances', getAccountId(region), region, 'tag', tag, tagBackend)
+    instanceList = discoveryCache.get(cacheKey)
+    if instanceList is not None:
+        if len(instanceList) > 0:
+            yield instanceList
+        return
+    instanceList = []
+    for clusterInstanceList in timedIter('discovery', discoverClusterInstances(client, clusterId, region, tag, tagBackend)):
+        instanceList = instanceList + clusterInstanceList
+        yield clusterInstanceList
+    discoveryCache.put(cacheKey, instanceList)
 
-def getClusterById(client, clusterId: str, region: str) -> Dict:
-    dbcluster = {}
+def discoverClusterInstances(client, clusterId: str, region: str, tag: str, tagBackend: str = 'describe'):
     if clusterId != None:
-        response = client.describe_db_clusters(
-            DBClusterIdentifier = clusterId,
-            Marker = 'string'
-            )
-        dbclusters = response['DBClusters']
-        dbcluster = dbclusters[0] if len(dbclusters) > 0 else {}
-    return dbcluster
+        yield from iterDbClusterInstances(iterDbClusters(client, splitClusterIds(clusterId)))
+        return
+    if tag == None:
+        return
+    tagExpression = parseTagExpression(tag)
+    if tagBackend == 'tagging':
+        yield from iterDbClusterInstances(iterTaggedDbClusters(client, region, tagExpression))
+        return
+    # no server side filter for tags in describe_db_clusters, match TagList of each cluster of the page
+    for dbclusters in iterDbClusters(client):
+        yield from iterDbClusterInstances([[dbcluster for dbcluster in dbclusters if tagExpressionMatched(tagExpression, dbcluster.get("TagList", []))]])
+
+# discover the instances of many regions at the same time, yields (region, instance list) of each page as soon as a region returns it
+def iterRegionsClusterInstances(regions: List, clusterId: str, tag: str, workers: int = 8, tagBackend: str = 'describe'):
+    pageQueue = queue.Queue()
+    def discoverRegion(regionName: str):
+        try:
+            for clusterInstanceList in getClusterInstances(getClient('rds', regionName), clusterId, regionName, tag, tagBackend):
+                pageQueue.put((regionName, clusterInstanceList, None))
+        except Exception as e:
+            pageQueue.put((regionName, None, e))
+        finally:
+            pageQueue.put((regionName, None, None))
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(regions)))) as executor:
+        for regionName in regions:
+            executor.submit(discoverRegion, regionName)
+        doneNum = 0
+        while doneNum < len(regions):
+            regionName, clusterInstanceList, error = pageQueue.get()
+            if error is not None:
+                raise error
+            if clusterInstanceList is None:
+                doneNum = doneNum + 1
+                continue
+            yield regionName, clusterInstanceList
 
 '''metric name is from customer needs, such as [CPUUtilization, SelectLatency, InsertLatency,
    UpdateLatency, DeleteLatency, FreeableMemory, WriteIOPS, ReadIOPS]
  '''
 # metricName = 'CPUUtilization'
 # get Widgets from aws cloud watch
-def getConsoleWidgets(client, dashName: str, region_name: str) -> List:
+# useCache takes the dashboard from the discovery cache when it is fresh, only for reading like --download:
+# update and sync edit the live dashboard, a cached one would overwrite the console edits made within the TTL
+def getConsoleWidgets(client, dashName: str, region_name: str, useCache: bool = False) -> List:
     # step1. get dashboard template
-    response = getDashboard(client, dashName)
-    dashboardBody = response['DashboardBody']
+    cacheKey = ('dashboard', getAccountId(region_name), region_name, dashName) if discoveryCache.enabled else None
+    dashboardBody = discoveryCache.get(cacheKey) if cacheKey is not None and useCache else None
+    if dashboardBody is None:
+        response = getDashboard(client, dashName)
+        dashboardBody = response['DashboardBody']
+        if cacheKey is not None:
+            discoveryCache.put(cacheKey, dashboardBody)
     bodyJson =  json.loads(dashboardBody)
     #print(response['DashboardBody'])
     return bodyJson['widgets']
@@ -278,185 +1396,734 @@ def listAllDashboards(client, dashName: str, region_name: str):
     #print(type(response['DashboardEntries']))
     return response['DashboardEntries']
 
-# open the local json config
-def getTemplateWidgets() -> List:
-    f = open('Aurora_monitor_DashboardBody.json','r')
-    widgetsList = json.load(f)
-    f.close()
-    #print(type(bodyJson))
-    return widgetsList
-
 # dump json object to local file
 def writeTemplateWidgets(unloadFile, curWidgets):
     with open (unloadFile,'w') as f:
         json.dump(curWidgets, f)
 
-# create a new widgets with a real clusterId and instances
-def initDashboardWidgets(templateWidgets: List, srvSKU: str, clusterInstanceList: List, region: str) -> List:
-    metriList = buildAllMetricList(templateWidgets, srvSKU)
-    for metricName in metriList:
-        initWidgets = updateWidgetJson(templateWidgets, srvSKU, metricName, clusterInstanceList, region, True)
-    return initWidgets
+# error codes of AWS when the API rate is exceeded
+THROTTLING_CODES = {'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException', 'RequestThrottled', 'RequestThrottledException'}
 
-def getClustersByIds(client, clusterIds: str, region: str) -> List:
-    if clusterIds is None:
-        print("Error: no clusterId be input, exit tagging/marking!")
-        exit()
-    clusterIdList = clusterIds.split(",")
-    clusters = []
-    for j in range(len(clusterIdList)):
-        clusterId = clusterIdList[j]
-        clusters.append(getClusterById(client, clusterId, region))
-    return clusters
+def isThrottlingError(e: Exception) -> bool:
+    response = getattr(e, 'response', None)
+    return isinstance(response, dict) and response.get('Error', {}).get('Code') in THROTTLING_CODES
 
-# tag all clusters user input
-def taggingClustersWithTag(clusterIds: str, region: str, tag: str):
+'''
+    Backoff shared by the workers calling one API: a throttled call doubles the delay of every worker,
+    successful calls halve it again, so the pool slows down together and speeds up when AWS lets it
+'''
+class AdaptiveBackoff:
+    def __init__(self, baseDelay: float = 0.1, maxDelay: float = 20.0):
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.delay = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        delay = self.delay
+        if delay > 0:
+            time.sleep(delay / 2 + random.uniform(0, delay / 2))
+
+    def onThrottle(self):
+        with self.lock:
+            self.delay = min(self.maxDelay, max(self.baseDelay, self.delay * 2))
+
+    def onSuccess(self):
+        with self.lock:
+            self.delay = self.delay / 2 if self.delay > self.baseDelay else 0.0
+
+# call an AWS API with the shared backoff, retry when throttled
+def callWithBackoff(backoff: AdaptiveBackoff, fn, maxAttempts: int = 8, **kwargs):
+    attempt = 1
+    while True:
+        backoff.wait()
+        try:
+            response = fn(**kwargs)
+            backoff.onSuccess()
+            return response
+        except Exception as e:
+            if not isThrottlingError(e) or attempt >= maxAttempts:
+                raise
+            backoff.onThrottle()
+            attempt = attempt + 1
+
+# account id of the credentials, to build ARNs
+accountIdMap = {}
+def getAccountId(region: str) -> str:
+    if region not in accountIdMap:
+        accountIdMap[region] = getClient('sts', region).get_caller_identity()['Account']
+    return accountIdMap[region]
+
+# build the ARN of a DB cluster without describing it, arn:aws:rds:ap-northeast-1:123456789012:cluster:aurora-1
+def buildClusterArn(clusterId: str, region: str, accountId: str) -> str:
+    partition = 'aws'
+    if region.startswith('cn-'):
+        partition = 'aws-cn'
+    elif region.startswith('us-gov-'):
+        partition = 'aws-us-gov'
+    return "arn:%s:rds:%s:%s:cluster:%s" % (partition, region, accountId, clusterId)
+
+# resolve the ARNs of clusters with batched describe_db_clusters, return {clusterId: DBClusterArn}, ids not found are left out
+def resolveClusterArns(client, clusterIdList: List) -> Dict:
+    clusterArnMap = {}
+    for dbclusters in iterDbClusters(client, clusterIdList):
+        for dbcluster in dbclusters:
+            clusterArnMap[dbcluster.get("DBClusterIdentifier")] = dbcluster.get("DBClusterArn")
+    return clusterArnMap
+
+'''
+    add or remove a tag for many clusters: ARNs are resolved in batches, or built from the account when arnFromId,
+    tags are written by a bounded worker pool with adaptive backoff, and every cluster is reported at the end instead of aborting
+    return {clusterId: None when done, or the error message}
+'''
+def bulkTagClusters(clusterIds: str, region: str, tag: str, isRemove: bool = False, workers: int = 8, arnFromId: bool = False) -> Dict:
     tagPair = tag.split(":",1)
     key = tagPair[0]
     value = tagPair[1]
     client = getClient('rds', region)
-    clusters = getClustersByIds(client, clusterIds, region)
-    print("You have %d RDS clusters want to tag." % len(clusters))
-    x = 0
-    for i in range(len(clusters)):
-        cluster = clusters[i]
-        clusterArn = cluster.get("DBClusterArn")
-        client.add_tags_to_resource(
-            ResourceName = clusterArn,
-            Tags=[
-                {
-                    'Key': key,
-                    'Value': value
-                },
-            ]
-        )
-        x = x + 1
-    print("%d RDS clusters have been tagged!" % x)
-
-def removeTagForClusters(clusterIds: str, region: str, tag: str):
-    tagPair = tag.split(":",1)
-    key = tagPair[0]
-    client = getClient('rds', region)
-    clusters = getClustersByIds(client, clusterIds, region)
-    print("You have %d RDS clusters to remove tag." % len(clusters))
-    x = 0
-    for i in range(len(clusters)):
-        cluster = clusters[i]
-        clusterArn = cluster.get("DBClusterArn")
-        client.remove_tags_from_resource(
-            ResourceName = clusterArn,
-            TagKeys=[
-                key,
-            ],
-        )
-        x = x + 1
-    print("%d RDS clusters'tag %s have been removed!" % (x, tag))
+    clusterIdList = splitClusterIds(clusterIds)
+    logger.info("You have %d RDS clusters want to %s.", len(clusterIdList), "remove tag" if isRemove else "tag")
+    if arnFromId:
+        accountId = getAccountId(region)
+        clusterArnMap = {clusterId: buildClusterArn(clusterId, region, accountId) for clusterId in clusterIdList}
+    else:
+        clusterArnMap = resolveClusterArns(client, clusterIdList)
+    resultMap = {clusterId: "cluster not found in %s" % region for clusterId in clusterIdList if clusterId not in clusterArnMap}
+    backoff = AdaptiveBackoff()
+    def tagCluster(clusterId: str):
+        try:
+            if isRemove:
+                callWithBackoff(backoff, client.remove_tags_from_resource, ResourceName = clusterArnMap[clusterId], TagKeys = [key])
+            else:
+                callWithBackoff(backoff, client.add_tags_to_resource, ResourceName = clusterArnMap[clusterId], Tags = [{'Key': key, 'Value': value}])
+            return clusterId, None
+        except Exception as e:
+            return clusterId, str(e)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for clusterId, error in executor.map(tagCluster, [clusterId for clusterId in clusterIdList if clusterId in clusterArnMap]):
+            resultMap[clusterId] = error
+    failedList = [clusterId for clusterId in clusterIdList if resultMap[clusterId] is not None]
+    runMetrics.count('clusters_tagged_total', len(clusterIdList) - len(failedList), action='remove' if isRemove else 'add')
+    runMetrics.count('clusters_tag_errors_total', len(failedList), action='remove' if isRemove else 'add')
+    if isRemove:
+        logger.info("%d RDS clusters'tag %s have been removed!", len(clusterIdList) - len(failedList), tag)
+    else:
+        logger.info("%d RDS clusters have been tagged!", len(clusterIdList) - len(failedList))
+    for clusterId in failedList:
+        logger.error("Failed: %s, %s", clusterId, resultMap[clusterId], extra={'fields': {'event': 'tag_error', 'clusterId': clusterId, 'error': resultMap[clusterId]}})
+    return resultMap
+
+# tag all clusters user input
+def taggingClustersWithTag(clusterIds: str, region: str, tag: str, workers: int = 8, arnFromId: bool = False) -> Dict:
+    return bulkTagClusters(clusterIds, region, tag, False, workers, arnFromId)
+
+def removeTagForClusters(clusterIds: str, region: str, tag: str, workers: int = 8, arnFromId: bool = False) -> Dict:
+    return bulkTagClusters(clusterIds, region, tag, True, workers, arnFromId)
+
+'''
+    score the instances by their metrics over the last lookbackMinutes with batched GetMetricData
+    the queries of a region are split into calls of GET_METRIC_DATA_MAX_QUERIES queries, the calls run on a worker pool
+    regionInstanceMap: {region: clusterInstanceList}
+    return {(region, metricName, instanceId): score}, the score is the highest stat datapoint of the window, instances without datapoints have no score
+'''
+def rankInstanceMetrics(regionInstanceMap: Dict, srvSKU: str, metricNames: List, lookbackMinutes: int = 60, stat: str = 'Average', workers: int = 8) -> Dict:
+    endTime = datetime.now(timezone.utc)
+    startTime = endTime - timedelta(minutes=lookbackMinutes)
+    period = 300 if lookbackMinutes >= 5 else 60
+    batchList = []
+    for region, clusterInstanceList in regionInstanceMap.items():
+        instanceIds = sorted({instanceMap['DBInstanceIdentifier'] for instanceMap in clusterInstanceList})
+        keyList = [(region, metricName, instanceId) for metricName in metricNames for instanceId in instanceIds]
+        for k in range(0, len(keyList), GET_METRIC_DATA_MAX_QUERIES):
+            batchList.append((region, keyList[k:k + GET_METRIC_DATA_MAX_QUERIES]))
+    backoffMap = {region: AdaptiveBackoff() for region in regionInstanceMap}
+    def rankBatch(batch):
+        region, keyList = batch
+        queries = [{'Id': 'q%d' % k, 'ReturnData': True,
+                    'MetricStat': {'Metric': {'Namespace': srvSKU, 'MetricName': key[1], 'Dimensions': [{'Name': 'DBInstanceIdentifier', 'Value': key[2]}]},
+                                   'Period': period, 'Stat': stat}} for k, key in enumerate(keyList)]
+        client = getClient('cloudwatch', region)
+        scoreMap = {}
+        kwargs = {'MetricDataQueries': queries, 'StartTime': startTime, 'EndTime': endTime}
+        while True:
+            response = callWithBackoff(backoffMap[region], client.get_metric_data, **kwargs)
+            for metricResult in response.get('MetricDataResults', []):
+                values = metricResult.get('Values', [])
+                if len(values) > 0:
+                    key = keyList[int(metricResult['Id'][1:])]
+                    scoreMap[key] = max(scoreMap.get(key, values[0]), max(values))
+            if response.get('NextToken') is None:
+                return scoreMap
+            kwargs['NextToken'] = response['NextToken']
+    scoreMap = {}
+    if len(batchList) == 0:
+        return scoreMap
+    with runMetrics.stage('rank'), ThreadPoolExecutor(max_workers=max(1, min(workers, len(batchList)))) as executor:
+        for batchScoreMap in executor.map(rankBatch, batchList):
+            scoreMap.update(batchScoreMap)
+    return scoreMap
+
+'''
+    keep the top N instances of each metric by score, writers are always kept, instances without score rank last
+    return instanceLineKey of the lines of the instances left out, like (region, metricName, instanceId, role)
+'''
+def rejectedInstanceLines(regionInstanceMap: Dict, metricNames: List, scoreMap: Dict, topN: int) -> set:
+    rejectedLineKeySet = set()
+    for metricName in metricNames:
+        instanceList = [(region, instanceMap) for region, clusterInstanceList in regionInstanceMap.items() for instanceMap in clusterInstanceList]
+        instanceList.sort(key=lambda item: (-scoreMap.get((item[0], metricName, item[1]['DBInstanceIdentifier']), float('-inf')), item[0], item[1]['DBInstanceIdentifier']))
+        for region, instanceMap in instanceList[topN:]:
+            if instanceMap['Role'] != 'WRITER':
+                rejectedLineKeySet.add(instanceLineKey(region, metricName, instanceMap))
+    return rejectedLineKeySet
 
 srvSKU = 'AWS/RDS'
-# parameters check
-args = args_parse()
-clusterId = args.clusterId
-tag = args.tag
-region = args.region
-unloadFile =  args.download
-isInit = args.init
-isUpdate = args.update
-dashName = args.dashName
-isTagging = args.addtag
-removeTag = args.rmtag
-print("isInit = ", args.init) if isInit else print("")
-print("isUpdate = ", args.update) if isUpdate else print("")
-print("isTagging = ", args.addtag) if isTagging else print("")
-print("removeTag = ", args.rmtag) if removeTag else print("")
-
-
-if isInit or isTagging or removeTag:
+
+# fields of a dashboard job, the same names as the CLI options, a manifest entry sets any of them
+JOB_FIELDS = ['action', 'dashName', 'clusterId', 'tag', 'tagBackend', 'region', 'dashRegion', 'template', 'download',
+              'mode', 'searchToken', 'topN', 'rankWindow', 'rankStat', 'shard', 'maxMetricsPerWidget', 'maxBodyBytes']
+
+# build the dashboard job of the CLI options, action is None when no dashboard action is given
+def jobFromArgs(args) -> Dict:
+    job = {field: getattr(args, field) for field in JOB_FIELDS if field != 'action'}
+    job['action'] = 'init' if args.init else 'update' if args.update else 'sync' if args.sync else None
+    return job
+
+# check the parameters of a dashboard job, return the error or None
+def checkDashboardJob(job: Dict):
+    if job.get('action') not in ('init', 'update', 'sync'):
+        return "action %s is invalid, it is one of init, update, sync" % job.get('action')
     # clusterID is necessary in init
-    if clusterId is None:
-        print("Parameters Error: clusterId is needed in init mode or marking tag mode!")
-        exit()
-    if (isTagging or removeTag ) and tag is None:
-        print("Parameters Error: --tag is needed in mark tag mode!")
-        exit()
-else:
+    if job['action'] == 'init' and job.get('clusterId') is None:
+        return "clusterId is needed in init mode"
     # update mode , clusterId or tags is needed
-    if clusterId is None and tag is None:
-        print("Parameters Error: Ether clusterId or tag is necesary when update dashboard!")
-        exit()
-#dashboard Name can be None only when tagging clusters
-if dashName is None and (isInit or isUpdate):
-        print("Parameters Error: dashboard Name is necesary when init or update dashboard!")
-        exit()
-
-if tag != None:
-    tags = tag.split(":",1)
-    if len(tags) < 2:
-        print("Parameters Error: tag %s is invalid!" % tag)
-        exit()
+    if job.get('clusterId') is None and job.get('tag') is None:
+        return "Ether clusterId or tag is necesary when update or sync dashboard"
+    if job.get('dashName') is None:
+        return "dashboard Name is necesary when init, update or sync dashboard"
+    if job.get('region') is None:
+        return "region is necesary when init, update or sync dashboard"
+    if job.get('tag') is not None:
+        try:
+            parseTagExpression(job['tag'])
+        except ValueError as e:
+            return str(e)
+    if job.get('mode', 'static') not in ('static', 'search'):
+        return "mode %s is invalid, it is one of static, search" % job.get('mode')
+    # a SEARCH dashboard doesn't grow with the fleet, and its expressions are not split across shards
+    if job.get('mode') == 'search' and job.get('shard') is not None:
+        return "shard is not supported in search mode"
+    if job.get('topN') is not None and (job.get('mode') == 'search' or job['topN'] < 1):
+        return "topN is a positive number of instances, and it is not supported in search mode"
+    if job.get('searchToken') is not None and re.search('^[A-Za-z0-9]+$', job['searchToken']) is None:
+        return "searchToken %s is invalid, it has letters and digits only" % job['searchToken']
+    return None
 
-if __name__ == '__main__':
-    if isTagging:
-        taggingClustersWithTag(clusterId, region, tag)
-        exit()
-    if removeTag:
-        removeTagForClusters(clusterId, region, tag)
-        exit()
-    # get template of dashboard'
-    client = getClient('rds', region)
-    # step2. get clusterInstanceList, [{'Role': 'WRITER', 'DBClusterIdentifier': 'aurora-1', 'DBInstanceIdentifier': 'aurora-1-primary'},{'Role': 'READER', 'DBClusterIdentifier': 'aurora-1', 'DBInstanceIdentifier': 'aurora-1-replica1'}]
-    clusterInstanceList = []
+'''
+    Discovery shared by the jobs of one process: each (region, selector) is described once,
+    the jobs asking for the same one at the same time wait for the first and reuse its pages
+'''
+class SharedDiscovery:
+    def __init__(self):
+        self.futureMap = {}
+        self.lock = threading.Lock()
+
+    def getRegionInstances(self, region: str, clusterId: str, tag: str, tagBackend: str) -> List:
+        key = (region, clusterId, tag, tagBackend)
+        with self.lock:
+            future = self.futureMap.get(key)
+            isOwner = future is None
+            if isOwner:
+                future = Future()
+                self.futureMap[key] = future
+        if isOwner:
+            try:
+                future.set_result(list(getClusterInstances(getClient('rds', region), clusterId, region, tag, tagBackend)))
+            except Exception as e:
+                future.set_exception(e)
+        return future.result()
+
+    # the same as iterRegionsClusterInstances, from the shared pages
+    def iterRegionsClusterInstances(self, regions: List, clusterId: str, tag: str, workers: int = 8, tagBackend: str = 'describe'):
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(regions)))) as executor:
+            futureRegionMap = {executor.submit(self.getRegionInstances, regionName, clusterId, tag, tagBackend): regionName for regionName in regions}
+            for future in as_completed(futureRegionMap):
+                for clusterInstanceList in future.result():
+                    yield futureRegionMap[future], clusterInstanceList
+
+# regions to discover and the region of the dashboard of a job, the dashboard region defaults to the first region
+def jobRegions(job: Dict):
+    regionInput = job['region'] if isinstance(job['region'], str) else ",".join(job['region'])
+    dashRegion = job.get('dashRegion')
+    if dashRegion is None:
+        dashRegion = DEFAULT_REGION if regionInput.strip() == 'all' else regionInput.split(",")[0].strip()
+    return parseRegions(regionInput, dashRegion), dashRegion
+
+'''
+    run one dashboard job: init, update or sync a dashboard (or its shards) with the clusters of the job
+    workers: threads to discover regions and put shards
+    sharedDiscovery: reuse the discovery of other jobs of the process, None to stream discovery for this job only
+    return the result {'dashName', 'action', 'status', 'instances', 'message'}, status is one of
+    created, updated, unchanged, downloaded, skipped, failed
+'''
+def runDashboardJob(job: Dict, workers: int = 8, sharedDiscovery: SharedDiscovery = None) -> Dict:
+    result = {'dashName': job.get('dashName'), 'action': job.get('action'), 'status': 'failed', 'instances': 0, 'message': ''}
+    def finish(status: str, message: str) -> Dict:
+        result['status'] = status
+        result['message'] = message
+        runMetrics.count('dashboard_jobs_total', action=result['action'], status=status)
+        logger.log(logging.ERROR if status == 'failed' else logging.INFO, message, extra={'fields': dict(result, event='dashboard_job')})
+        return result
+    error = checkDashboardJob(job)
+    if error is not None:
+        return finish('failed', "Parameters Error: %s!" % error)
+    isInit = job['action'] == 'init'
+    isSync = job['action'] == 'sync'
+    dashName = job['dashName']
+    clusterId = job.get('clusterId')
+    tag = job.get('tag')
+    tagBackend = job.get('tagBackend') or 'describe'
+    shardMode = job.get('shard')
+    isSearch = job.get('mode') == 'search'
+    topN = job.get('topN')
+    maxMetricsPerWidget = job.get('maxMetricsPerWidget') or DEFAULT_MAX_METRICS_PER_WIDGET
+    maxBodyBytes = job.get('maxBodyBytes') or DEFAULT_MAX_BODY_BYTES
     try:
-        clusterInstanceList = getClusterInstances(client, clusterId, region, tag)
-    except client.exceptions.DBClusterNotFoundFault as e:
-        print("Your RDS cluster not found: %s" % clusterId)
-        exit()
-    print("Your RDS cluster have %d instances." % len(clusterInstanceList))
-    if len(clusterInstanceList) == 0:
-        print("Your RDS cluster has no instances: %s" % clusterId)
-        exit()
-    print(clusterInstanceList)
+        regions, dashRegion = jobRegions(job)
+        client = getClient('cloudwatch', dashRegion)
+    except Exception as e:
+        return finish('failed', "%s, list regions error: %s" % (dashName, e))
     ################ step0. whether init a dashboard
-    dashboardExist = False
     if isInit:
-        client = getClient('cloudwatch', region)
+        # dashName has to be unique, if not ,exit
         try:
-            curAllDashboards = listAllDashboards(client, dashName, region)
-            for i in range(len(curAllDashboards)):
-                dashboard =  curAllDashboards[i]
-                if dashName == dashboard.get("DashboardName"):
-                    dashboardExist = True
-                    print("the dashboard name %s has been found in cloudWatch" % dashName)
-                    break
+            if shardMode == 'dashboards':
+                existNames = listDashboardShardNames(client, dashName, dashRegion)
+            else:
+                existNames = [dashboard.get("DashboardName") for dashboard in listAllDashboards(client, dashName, dashRegion) if dashName == dashboard.get("DashboardName")]
         except Exception as e:
-            print("%s, list dashboards error: %s" % (dashName, e))
-            exit()
-        if not dashboardExist:
-            # dashName has to be unique, if not ,exit
-            templateWidgets = getTemplateWidgets()  # get from local json template
-            # create a new dashboard named $dashName
-            initWidgets = initDashboardWidgets(templateWidgets, srvSKU, clusterInstanceList, region)
-            # client = getClient('cloudwatch', region)
-            updateDashboard(client, dashName, createDashboardBody(initWidgets))
-            print("the dashboard %s created in cloudWatch." % dashName)
-        exit()
-    if isUpdate:
+            return finish('failed', "%s, list dashboards error: %s" % (dashName, e))
+        if len(existNames) > 0:
+            return finish('skipped', "the dashboard name %s has been found in cloudWatch" % existNames[0])
+        try:
+            templatePlan = getTemplatePlan(job.get('template') or DEFAULT_TEMPLATE, srvSKU)  # compiled from local json template
+        except (OSError, ValueError) as e:
+            return finish('failed', "%s, read template error: %s" % (dashName, e))
+        shardWidgetsList = []
+    else:
         ############### if not init, add metrics for cluster
         # step1. download template from cloudWatch dashboard
-        client = getClient('cloudwatch', region)
         try:
-            curWidgets = getConsoleWidgets(client, dashName, region)
+            # optional, dump dashboard to a local json file, and exit
+            if job.get('download') is not None:
+                writeTemplateWidgets(job['download'], getConsoleWidgets(client, dashName, dashRegion, useCache=True))
+                return finish('downloaded', "Unload template compete: %s" % job['download'])
+            if shardMode == 'dashboards':
+                shardNames = listDashboardShardNames(client, dashName, dashRegion)
+                if len(shardNames) == 0:
+                    return finish('failed', "No dashboard shard %s-1, %s-2 ... found in cloudWatch, init them first!" % (dashName, dashName))
+                shardWidgetsList = [getConsoleWidgets(client, shardName, dashRegion) for shardName in shardNames]
+                # new shards repeat the first one
+                templatePlan = TemplatePlan(json.dumps(shardWidgetsList[0]), srvSKU)
+            else:
+                curWidgets = getConsoleWidgets(client, dashName, dashRegion)
+        except Exception as e:
+            return finish('failed', "%s, get dashboard error: %s" % (dashName, e))
+    # step2. get clusterInstanceList page by page, [{'Role': 'WRITER', 'DBClusterIdentifier': 'aurora-1', 'DBInstanceIdentifier': 'aurora-1-primary'},{'Role': 'READER', 'DBClusterIdentifier': 'aurora-1', 'DBInstanceIdentifier': 'aurora-1-replica1'}]
+    # step3. index curWidgets once and add each page's instances into the widget of every metric
+    if shardMode == 'dashboards':
+        model = DashboardShards(dashName, srvSKU, templatePlan, maxMetricsPerWidget, maxBodyBytes)
+        for shardWidgets in shardWidgetsList:
+            model.addShard(shardWidgets)
+    elif isInit:
+        model = templatePlan.newModel(maxMetricsPerWidget if shardMode == 'widgets' else None, shardMode == 'widgets')
+    else:
+        model = DashboardModel(curWidgets, srvSKU, maxMetricsPerWidget if shardMode == 'widgets' else None, shardMode == 'widgets')
+    # search mode plots the clusters by SEARCH expressions, metrics which are not plotted by DBClusterIdentifier keep static lines
+    if isSearch:
+        fallbackNames = model.useSearch()
+        if len(fallbackNames) > 0:
+            logger.info("Metrics %s can't be selected by SEARCH, they keep static lines.", ", ".join(fallbackNames))
+    # sync mode needs the whole fleet first, to delete the metric lines of instances not found any more before adding new ones
+    # so does ranking the instances for the top N
+    # regions are discovered at the same time, each metric line is tagged with the region of its instance
+    instanceAmount = 0
+    syncInstanceLists = []
+    regionClusterMap = {}
+    discovery = sharedDiscovery.iterRegionsClusterInstances if sharedDiscovery is not None else iterRegionsClusterInstances
+    try:
+        for region, clusterInstanceList in discovery(regions, clusterId, tag, workers, tagBackend):
+            if isSync or topN is not None:
+                syncInstanceLists.append((region, clusterInstanceList))
+            else:
+                with runMetrics.stage('mutate'):
+                    model.addInstances(clusterInstanceList, region)
+            if isSearch:
+                regionClusterMap.setdefault(region, set()).update(instanceMap['DBClusterIdentifier'] for instanceMap in clusterInstanceList)
+            instanceAmount = instanceAmount + len(clusterInstanceList)
+    except Exception as e:
+        return finish('failed', "Discover RDS clusters error: %s" % e)
+    result['instances'] = instanceAmount
+    runMetrics.count('instances_discovered_total', instanceAmount)
+    logger.info("Your RDS cluster have %d instances.", instanceAmount)
+    if instanceAmount == 0:
+        return finish('failed', "Your RDS cluster has no instances: %s" % (clusterId if clusterId != None else tag))
+    rejectedLineKeySet = None
+    if topN is not None:
+        # rank the instances found on each run, lines of the instances out of the top N are deleted and not added
+        regionInstanceMap = {}
+        for region, clusterInstanceList in syncInstanceLists:
+            regionInstanceMap.setdefault(region, []).extend(clusterInstanceList)
+        metricNames = model.metricNames()
+        try:
+            scoreMap = rankInstanceMetrics(regionInstanceMap, srvSKU, metricNames, job.get('rankWindow') or 60, job.get('rankStat') or 'Average', workers)
         except Exception as e:
-            print(e)
-            exit()
-        # optional, dump dashboard to a local json file, and exit
-        if unloadFile is not None:
-            writeTemplateWidgets(unloadFile, curWidgets)
-            print("Unload template compete: %s" % unloadFile)
-            exit()
-        # step3. add clusterInstanceList's metric one by one into curWidgets 
-        metriList = buildAllMetricList(curWidgets, srvSKU)
-        for metricName in metriList:
-            curWidgets = updateWidgetJson(curWidgets, srvSKU, metricName, clusterInstanceList, region, isInit)
-        # step4. update dashboard
-        updateDashboard(client, dashName, createDashboardBody(curWidgets))
-        #print("new dashboardBody: ", res['DashboardBody'])
+            return finish('failed', "Rank RDS instances error: %s" % e)
+        rejectedLineKeySet = rejectedInstanceLines(regionInstanceMap, metricNames, scoreMap, topN)
+        logger.info("Top %d instances and the writers of %d metrics are kept, %d metric lines are left out.", topN, len(metricNames), len(rejectedLineKeySet))
+    if isSync:
+        desiredInstanceSet = set()
+        for region, clusterInstanceList in syncInstanceLists:
+            for instanceMap in clusterInstanceList:
+                desiredInstanceSet.add((region, instanceMap['DBInstanceIdentifier'], instanceMap['Role']))
+        with runMetrics.stage('mutate'):
+            removedNum = model.pruneInstances(desiredInstanceSet, rejectedLineKeySet)
+        logger.info("%d metric lines of instances not found any more are deleted.", removedNum)
+    elif rejectedLineKeySet is not None:
+        with runMetrics.stage('mutate'):
+            removedNum = model.pruneInstances(None, rejectedLineKeySet)
+        logger.info("%d metric lines of instances out of the top %d are deleted.", removedNum, topN)
+    if isSync or topN is not None:
+        with runMetrics.stage('mutate'):
+            for region, clusterInstanceList in syncInstanceLists:
+                model.addInstances(clusterInstanceList, region, rejectedLineKeySet=rejectedLineKeySet)
+    if isSearch:
+        with runMetrics.stage('mutate'):
+            searchNum = model.applySearch(regionClusterMap, job.get('searchToken'), not isSync)
+        logger.info("%d SEARCH expressions select the clusters of %d regions.", searchNum, len(regionClusterMap))
+    with runMetrics.stage('layout'):
+        model.layoutWidgets()
+    # step4. update dashboard, shards are put at the same time, dashboards not changed are not put
+    if shardMode == 'dashboards':
+        dashBodies = model.toBodies(not isInit)
+        if not updateDashboards(client, dashBodies, workers):
+            return finish('failed', "some dashboard shards of %s failed to update in cloudWatch." % dashName)
+        if len(dashBodies) == 0:
+            return finish('unchanged', "0 of %d dashboard shards of %s are updated in cloudWatch." % (len(model.shardList), dashName))
+        return finish('created' if isInit else 'updated', "%d of %d dashboard shards of %s are updated in cloudWatch." % (len(dashBodies), len(model.shardList), dashName))
+    if not isInit and not model.isChanged():
+        return finish('unchanged', "the dashboard %s is not changed, skip updating it." % dashName)
+    if shardMode == 'widgets' and model.bodyBytes > maxBodyBytes:
+        logger.warning("Warning: dashboard body of %s is about %d bytes, over the budget %d, try --shard dashboards", dashName, model.bodyBytes, maxBodyBytes)
+    if not updateDashboard(client, dashName, model.toBody()):
+        return finish('failed', "the dashboard %s failed to update in cloudWatch." % dashName)
+    if isInit:
+        return finish('created', "the dashboard %s created in cloudWatch." % dashName)
+    return finish('updated', "the dashboard %s updated in cloudWatch." % dashName)
+
+# load a manifest of dashboard jobs from a json file, or a yaml file when PyYAML is installed
+# the manifest is {"workers": 4, "defaults": {...}, "dashboards": [{...}, ...]} or just the list of dashboards
+def loadManifest(manifestFile: str) -> Dict:
+    with open(manifestFile, 'r') as f:
+        if manifestFile.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError("PyYAML is needed to read the yaml manifest %s, pip install pyyaml" % manifestFile)
+            manifest = yaml.safe_load(f)
+        else:
+            manifest = json.load(f)
+    if isinstance(manifest, list):
+        manifest = {'dashboards': manifest}
+    if not isinstance(manifest, dict) or not isinstance(manifest.get('dashboards'), list):
+        raise ValueError("manifest %s has no dashboards list" % manifestFile)
+    return manifest
+
+# the dashboard jobs of a manifest, defaultJob: fields of the CLI, the manifest defaults and then each dashboard entry override them
+def manifestJobs(manifest: Dict, defaultJob: Dict) -> List:
+    defaults = {field: value for field, value in defaultJob.items() if value is not None}
+    defaults.setdefault('action', 'update')
+    defaults.update(manifest.get('defaults', {}))
+    jobList = []
+    for entry in manifest['dashboards']:
+        job = dict(defaults)
+        job.update(entry)
+        jobList.append(job)
+    return jobList
+
+'''
+    run the dashboard jobs of a manifest on a worker pool in this process, clients and discovery are shared by the jobs
+    defaultJob: fields of the CLI, the manifest defaults and then each dashboard entry override them
+'''
+def runManifest(manifest: Dict, defaultJob: Dict, workers: int = 8) -> List:
+    jobList = manifestJobs(manifest, defaultJob)
+    jobWorkers = manifest.get('workers', workers)
+    sharedDiscovery = SharedDiscovery()
+    with ThreadPoolExecutor(max_workers=max(1, jobWorkers)) as executor:
+        results = list(executor.map(lambda job: runDashboardJob(job, workers, sharedDiscovery), jobList))
+    return results
+
+# print the summary of the dashboard jobs
+def printJobReport(results: List):
+    logger.info("########## %d dashboards", len(results))
+    statusCountMap = {}
+    for result in results:
+        statusCountMap[result['status']] = statusCountMap.get(result['status'], 0) + 1
+        logger.info("%-40s %-7s %-10s %6d instances  %s", result['dashName'], result['action'], result['status'], result['instances'], result['message'],
+                    extra={'fields': dict(result, event='dashboard_report')})
+    logger.info("########## %s", ", ".join("%s: %d" % (status, count) for status, count in sorted(statusCountMap.items())),
+                extra={'fields': dict(statusCountMap, event='dashboard_summary')})
+
+'''
+    Watch daemon: every interval seconds, with jitter so many daemons don't poll AWS together, the clusters of every
+    dashboard job are discovered once for all jobs, and the membership of each job is fingerprinted.
+    Only the jobs whose membership changed since their last good run are queued, and workers update those dashboards
+    with the pages discovered in the cycle. Jobs with topN are queued on every cycle to be ranked again, and a dashboard
+    not updated for maxStaleness seconds is queued as well, so edits made out of this tool are reconciled. A dashboard still queued or running is not queued again, so cycles never
+    overlap on one dashboard. Clients live as long as the process.
+'''
+class DashboardWatcher:
+    def __init__(self, jobList: List, interval: float = 45, jitter: float = 0.1, workers: int = 8, jobWorkers: int = 4, metricsOut: str = None,
+                 maxStaleness: float = 900):
+        self.jobList = jobList
+        self.interval = interval
+        self.jitter = jitter
+        self.maxStaleness = maxStaleness
+        self.workers = workers
+        self.jobWorkers = max(1, jobWorkers)
+        self.metricsOut = metricsOut
+        # dashName -> membership fingerprint of its last good run
+        self.fingerprintMap = {}
+        # dashName -> time.monotonic() of its last good run
+        self.refreshTimeMap = {}
+        # dashboards queued or running
+        self.pendingSet = set()
+        self.lock = threading.Lock()
+        self.jobQueue = queue.Queue(maxsize=max(1, len(jobList)))
+        self.stopEvent = threading.Event()
+        # regions of each job, --region all is listed once
+        self.regionMap = {}
+
+    # hash of the sorted (region, cluster, instance, role) of a job, discovered through the discovery of the cycle
+    def fingerprint(self, job: Dict, sharedDiscovery: SharedDiscovery) -> tuple:
+        if job['dashName'] not in self.regionMap:
+            self.regionMap[job['dashName']] = jobRegions(job)[0]
+        memberList = []
+        for region, clusterInstanceList in sharedDiscovery.iterRegionsClusterInstances(self.regionMap[job['dashName']], job.get('clusterId'), job.get('tag'),
+                                                                                        self.workers, job.get('tagBackend') or 'describe'):
+            for instanceMap in clusterInstanceList:
+                memberList.append([region, instanceMap['DBClusterIdentifier'], instanceMap['DBInstanceIdentifier'], instanceMap['Role']])
+        memberList.sort()
+        return hashlib.sha256(json.dumps(memberList).encode('utf-8')).hexdigest(), len(memberList)
+
+    # fingerprint every job and queue the changed ones, return the number queued
+    def runCycle(self) -> int:
+        sharedDiscovery = SharedDiscovery()
+        jobList = []
+        with self.lock:
+            for job in self.jobList:
+                if job['dashName'] in self.pendingSet:
+                    runMetrics.count('watch_jobs_skipped_total', reason='pending')
+                    logger.info("%s is still being updated, skip it in this cycle.", job['dashName'])
+                else:
+                    jobList.append(job)
+        def fingerprintJob(job: Dict):
+            try:
+                return self.fingerprint(job, sharedDiscovery)
+            except Exception as e:
+                logger.error("%s, discover RDS clusters error: %s", job['dashName'], e, extra={'fields': {'event': 'watch_error', 'dashName': job['dashName'], 'error': str(e)}})
+                return None, 0
+        queuedNum = 0
+        now = time.monotonic()
+        with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(jobList) or 1))) as executor:
+            for job, (fingerprint, memberNum) in zip(jobList, executor.map(fingerprintJob, jobList)):
+                dashName = job['dashName']
+                if fingerprint is None:
+                    runMetrics.count('watch_jobs_skipped_total', reason='error')
+                    continue
+                if self.fingerprintMap.get(dashName) == fingerprint:
+                    if job.get('topN') is not None:
+                        runMetrics.count('watch_jobs_refreshed_total', reason='rank')
+                    elif self.maxStaleness > 0 and now - self.refreshTimeMap.get(dashName, now) >= self.maxStaleness:
+                        runMetrics.count('watch_jobs_refreshed_total', reason='stale')
+                    else:
+                        runMetrics.count('watch_jobs_skipped_total', reason='unchanged')
+                        continue
+                if memberNum == 0:
+                    # nothing to add, and an empty fleet never empties a dashboard
+                    logger.warning("%s has no instances found, skip it.", dashName)
+                    self.fingerprintMap[dashName] = fingerprint
+                    continue
+                with self.lock:
+                    self.pendingSet.add(dashName)
+                try:
+                    self.jobQueue.put_nowait((job, sharedDiscovery, fingerprint))
+                except queue.Full:
+                    with self.lock:
+                        self.pendingSet.discard(dashName)
+                    runMetrics.count('watch_jobs_skipped_total', reason='queue_full')
+                    continue
+                queuedNum = queuedNum + 1
+        runMetrics.count('watch_jobs_queued_total', queuedNum)
+        return queuedNum
+
+    # worker: update the queued dashboards, the fingerprint is kept only when the update went through
+    def work(self):
+        while True:
+            item = self.jobQueue.get()
+            if item is None:
+                self.jobQueue.task_done()
+                return
+            job, sharedDiscovery, fingerprint = item
+            try:
+                result = runDashboardJob(job, self.workers, sharedDiscovery)
+                if result['status'] in ('created', 'updated', 'unchanged'):
+                    self.fingerprintMap[job['dashName']] = fingerprint
+                    self.refreshTimeMap[job['dashName']] = time.monotonic()
+            except Exception as e:
+                logger.exception("%s, update dashboard error: %s", job['dashName'], e)
+            finally:
+                with self.lock:
+                    self.pendingSet.discard(job['dashName'])
+                self.jobQueue.task_done()
+
+    def stop(self):
+        self.stopEvent.set()
+
+    # run cycles until stop() or KeyboardInterrupt, or cycles times when cycles > 0
+    def run(self, cycles: int = 0):
+        workerList = [threading.Thread(target=self.work, name='watch-worker-%d' % k, daemon=True) for k in range(self.jobWorkers)]
+        for worker in workerList:
+            worker.start()
+        cycleNum = 0
+        try:
+            while not self.stopEvent.is_set():
+                startTime = time.monotonic()
+                queuedNum = self.runCycle()
+                cycleNum = cycleNum + 1
+                runMetrics.count('watch_cycles_total')
+                logger.info("Watch cycle %d: %d of %d dashboards changed.", cycleNum, queuedNum, len(self.jobList),
+                            extra={'fields': {'event': 'watch_cycle', 'cycle': cycleNum, 'queued': queuedNum}})
+                if self.metricsOut is not None:
+                    try:
+                        runMetrics.write(self.metricsOut)
+                    except OSError as e:
+                        logger.error("Write run metrics error: %s", e)
+                if cycles > 0 and cycleNum >= cycles:
+                    break
+                delay = self.interval * (1 + random.uniform(-self.jitter, self.jitter)) - (time.monotonic() - startTime)
+                self.stopEvent.wait(max(0.0, delay))
+        except KeyboardInterrupt:
+            logger.info("Watch is stopped.")
+        finally:
+            # the dashboards queued are updated before the workers leave
+            for worker in workerList:
+                self.jobQueue.put(None)
+            for worker in workerList:
+                worker.join()
+
+# run --watch for the dashboard of the options or of the manifest until stopped, SIGTERM stops it after the running updates
+def runWatch(args) -> int:
+    jobWorkers = 1
+    if args.manifest is not None:
+        try:
+            manifest = loadManifest(args.manifest)
+        except (OSError, ValueError) as e:
+            logger.error("Manifest Error: %s", e)
+            return 1
+        jobList = manifestJobs(manifest, jobFromArgs(args))
+        jobWorkers = manifest.get('workers', args.workers)
+    else:
+        jobList = [jobFromArgs(args)]
+    for job in jobList:
+        error = checkDashboardJob(job)
+        if error is None and job['action'] == 'init':
+            error = "init is not watched, init the dashboard first and watch it with update or sync"
+        if error is not None:
+            logger.error("Parameters Error: %s, %s!", job.get('dashName'), error)
+            return 1
+    if discoveryCache.enabled:
+        logger.warning("Warning: --cacheTtl %d delays the changes watched by as much, watch works without it.", discoveryCache.ttl)
+    watcher = DashboardWatcher(jobList, args.interval, args.jitter, args.workers, jobWorkers, args.metricsOut, args.maxStaleness)
+    signal.signal(signal.SIGTERM, lambda signum, frame: watcher.stop())
+    watcher.run(args.cycles)
+    return 0
+
+# log of the CLI to stdout, as plain text like print or as json lines
+def configureLogging(logFormat: str = 'text', logLevel: str = 'INFO'):
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonLogFormatter() if logFormat == 'json' else logging.Formatter('%(message)s'))
+    logger.handlers = [handler]
+    logger.setLevel(logLevel)
+    logger.propagate = False
+
+'''
+    command line entry, argv is the options without the program name, None reads sys.argv
+    return the exit code: 1 when a manifest dashboard failed or the manifest can't be read, 0 otherwise
+    the metrics of the run are written to --metricsOut however it ends
+'''
+def main(argv: List = None) -> int:
+    args = args_parse(argv)
+    configureLogging(args.logFormat, args.logLevel)
+    try:
+        return runCommand(args)
+    finally:
+        if args.metricsOut is not None:
+            try:
+                runMetrics.write(args.metricsOut)
+                logger.info("Run metrics are written to %s", args.metricsOut)
+            except OSError as e:
+                logger.error("Write run metrics error: %s", e)
+
+# run the command of the parsed options, return the exit code
+def runCommand(args) -> int:
+    global discoveryCache
+    # parameters check
+    clusterId = args.clusterId
+    tag = args.tag
+    isTagging = args.addtag
+    removeTag = args.rmtag
+    logger.debug("isInit = %s, isUpdate = %s, isSync = %s, isTagging = %s, removeTag = %s, manifest = %s",
+                 args.init, args.update, args.sync, isTagging, removeTag, args.manifest)
+
+    if isTagging or removeTag:
+        if clusterId is None:
+            logger.error("Parameters Error: clusterId is needed in marking tag mode!")
+            return 1
+        if tag is None:
+            logger.error("Parameters Error: --tag is needed in mark tag mode!")
+            return 1
+        if args.region is None or "," in args.region or args.region.strip() == 'all':
+            logger.error("Parameters Error: one region is needed in marking tag mode!")
+            return 1
+        try:
+            tagExpression = parseTagExpression(tag)
+        except ValueError as e:
+            logger.error("Parameters Error: %s!", e)
+            return 1
+        # a tag to add or remove is one key:value
+        if len(tagExpression) > 1 or len(tagExpression[0]) > 1:
+            logger.error("Parameters Error: tag %s is invalid!", tag)
+            return 1
+        if isTagging:
+            resultMap = taggingClustersWithTag(clusterId, args.region.strip(), tag, args.workers, args.arnFromId)
+        else:
+            resultMap = removeTagForClusters(clusterId, args.region.strip(), tag, args.workers, args.arnFromId)
+        return 1 if any(error is not None for error in resultMap.values()) else 0
+    discoveryCache = DiscoveryCache(args.cacheDir, args.cacheTtl, args.cacheMaxEntries, args.refresh)
+    if args.watch:
+        return runWatch(args)
+    if args.manifest is not None:
+        try:
+            manifest = loadManifest(args.manifest)
+        except (OSError, ValueError) as e:
+            logger.error("Manifest Error: %s", e)
+            return 1
+        results = runManifest(manifest, jobFromArgs(args), args.workers)
+        printJobReport(results)
+        return 1 if any(result['status'] == 'failed' for result in results) else 0
+    result = runDashboardJob(jobFromArgs(args), args.workers)
+    return 1 if result['status'] == 'failed' else 0
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,23 @@
+import logging
+import os
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import benchmark_dashboard
+import dashboard_custom
+
+# a synthetic fleet behind the in-process AWS stand-in of the benchmark, the template is read from the repo root
+@pytest.fixture
+def fakeAws(monkeypatch):
+    monkeypatch.chdir(ROOT_DIR)
+    dashboard_custom.logger.setLevel(logging.ERROR)
+    def install(clusterNum: int, instancesPerCluster: int = 2):
+        fake = benchmark_dashboard.FakeAws(clusterNum, instancesPerCluster)
+        benchmark_dashboard.installFakeAws(fake)
+        return fake
+    yield install
+    dashboard_custom.clientMap.clear()
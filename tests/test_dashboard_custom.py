@@ -0,0 +1,150 @@
+import collections
+import json
+
+import pytest
+
+import dashboard_custom
+from benchmark_dashboard import BENCH_REGION
+
+def dashboardWidgets(fake, dashName: str):
+    return json.loads(fake.dashboards[dashName])['widgets']
+
+def chainOf(title: str) -> str:
+    return title.rsplit(' (', 1)[0] if title.endswith(')') else title
+
+# label of every instance line -> names of the dashboards it is on
+def instanceDashboards(fake) -> dict:
+    labelMap = collections.defaultdict(set)
+    for dashName, dashboardBody in fake.dashboards.items():
+        for widgetDict in json.loads(dashboardBody)['widgets']:
+            for metricElementList in dashboard_custom.expandMetricLines(widgetDict['properties'].get('metrics', [])):
+                if dashboard_custom.isInstanceMetricLine(metricElementList):
+                    labelMap[metricElementList[-1]['label']].add(dashName)
+    return labelMap
+
+def test_shorthand_round_trip():
+    metrics = [['AWS/RDS', 'CPUUtilization', 'Role', 'WRITER', 'DBClusterIdentifier', 'aurora-1', {'label': 'aurora-1-1-WRITER'}],
+               ['AWS/RDS', 'CPUUtilization', 'Role', 'READER', 'DBClusterIdentifier', 'aurora-1', {'label': 'aurora-1-2-READER'}],
+               ['AWS/RDS', 'CPUUtilization', 'Role', 'READER', 'DBClusterIdentifier', 'aurora-2'],
+               [{'expression': 'SUM(METRICS())', 'label': 'total'}],
+               ['AWS/RDS', 'DMLLatency', 'Role', 'READER', 'DBClusterIdentifier', 'aurora-2', {'period': 60}],
+               ['AWS/RDS', 'DMLLatency', 'DBClusterIdentifier', 'aurora-2']]
+    compressed = dashboard_custom.compressMetricLines(metrics)
+    assert compressed[1] == ['...', 'READER', '.', '.', {'label': 'aurora-1-2-READER'}]
+    assert compressed[2] == ['...', 'aurora-2']
+    # no shorthand across an expression line, nor between lines of different lengths
+    assert compressed[4] == metrics[4] and compressed[5] == metrics[5]
+    assert dashboard_custom.expandMetricLines(compressed) == metrics
+    # "..." mixed with "." as the console writes it
+    consoleLines = [metrics[0], ['...', 'READER', '.', 'aurora-3'], ['.', 'Deadlocks', '...']]
+    assert dashboard_custom.expandMetricLines(consoleLines) == [metrics[0],
+        ['AWS/RDS', 'CPUUtilization', 'Role', 'READER', 'DBClusterIdentifier', 'aurora-3'],
+        ['AWS/RDS', 'Deadlocks', 'Role', 'READER', 'DBClusterIdentifier', 'aurora-3']]
+
+def test_grid_layout_never_overlaps():
+    layout = dashboard_custom.GridLayout()
+    cellSet = set()
+    for k in range(60):
+        width, height = [(6, 6), (12, 6), (24, 3), (8, 4), (6, 9)][k % 5]
+        x, y = layout.place(width, height)
+        assert 0 <= x and x + width <= dashboard_custom.GRID_COLUMNS
+        cells = {(x + i, y + j) for i in range(width) for j in range(height)}
+        # growing into the rows below never takes cells of another widget
+        newHeight = layout.grow(x, y, width, height, height + 3)
+        cells = cells | {(x + i, y + j) for i in range(width) for j in range(height, newHeight)}
+        assert cells.isdisjoint(cellSet)
+        cellSet = cellSet | cells
+    # the first slot is reading top to bottom and left to right
+    layout = dashboard_custom.GridLayout()
+    assert [layout.place(6, 6) for k in range(5)] == [(0, 0), (6, 0), (12, 0), (18, 0), (0, 6)]
+
+def test_shards_keep_their_instances_across_update_and_sync(fakeAws):
+    fake = fakeAws(30, 3)
+    clusterIds = [cluster['DBClusterIdentifier'] for cluster in fake.clusters]
+    job = {'dashName': 'fleet', 'region': BENCH_REGION, 'shard': 'dashboards', 'maxMetricsPerWidget': 10}
+    assert dashboard_custom.runDashboardJob(dict(job, action='init', clusterId=",".join(clusterIds[:10])))['status'] == 'created'
+    initMap = instanceDashboards(fake)
+    assert dashboard_custom.runDashboardJob(dict(job, action='update', tag='env:prod OR env:dev'))['status'] == 'updated'
+    updateMap = instanceDashboards(fake)
+    assert len(updateMap) == 90 and all(len(dashNameSet) == 1 for dashNameSet in updateMap.values())
+    assert all(updateMap[label] == dashNameSet for label, dashNameSet in initMap.items())
+    # sync drops the clusters which are not desired any more and moves no one
+    assert dashboard_custom.runDashboardJob(dict(job, action='sync', clusterId=",".join(clusterIds[5:])))['status'] == 'updated'
+    syncMap = instanceDashboards(fake)
+    assert len(syncMap) == 75 and all(syncMap[label] == updateMap[label] for label in syncMap)
+    assert dashboard_custom.runDashboardJob(dict(job, action='sync', clusterId=",".join(clusterIds[5:])))['status'] == 'unchanged'
+
+def test_tag_expression_and_binds_tighter_than_or():
+    assert dashboard_custom.parseTagExpression('env:prod AND team:pay OR tier:gold') == [[('env', 'prod'), ('team', 'pay')], [('tier', 'gold')]]
+    assert dashboard_custom.parseTagExpression('tier:gold OR env:prod AND team:pay') == [[('tier', 'gold')], [('env', 'prod'), ('team', 'pay')]]
+    assert dashboard_custom.parseTagExpression('ResourceGroup:pre') == [[('ResourceGroup', 'pre')]]
+    tagExpression = dashboard_custom.parseTagExpression('env:prod AND team:pay OR tier:gold')
+    assert dashboard_custom.tagExpressionMatched(tagExpression, [{'Key': 'tier', 'Value': 'gold'}])
+    assert dashboard_custom.tagExpressionMatched(tagExpression, [{'Key': 'env', 'Value': 'prod'}, {'Key': 'team', 'Value': 'pay'}])
+    assert not dashboard_custom.tagExpressionMatched(tagExpression, [{'Key': 'env', 'Value': 'prod'}, {'Key': 'tier', 'Value': 'silver'}])
+    for tagInput in ('env', ':prod', 'env:prod OR tier'):
+        with pytest.raises(ValueError):
+            dashboard_custom.parseTagExpression(tagInput)
+
+def test_widget_repeats_survive_init_update_sync(fakeAws):
+    fake = fakeAws(30, 3)
+    clusterIds = [cluster['DBClusterIdentifier'] for cluster in fake.clusters]
+    job = {'dashName': 'rep', 'region': BENCH_REGION, 'shard': 'widgets', 'maxMetricsPerWidget': 10}
+    assert dashboard_custom.runDashboardJob(dict(job, action='init', clusterId=",".join(clusterIds[:10])))['status'] == 'created'
+    assert dashboard_custom.runDashboardJob(dict(job, action='update', tag='env:prod OR env:dev'))['status'] == 'updated'
+    widgets = dashboardWidgets(fake, 'rep')
+    titleCount = collections.Counter(widgetDict['properties']['title'] for widgetDict in widgets)
+    assert [title for title, count in titleCount.items() if count > 1] == []
+    assert [title for title in titleCount if title.count(' (') > 1] == []
+    # every repeat chain is packed, only its last widget may have room
+    chainLineMap = collections.defaultdict(list)
+    for widgetDict in widgets:
+        chainLineMap[chainOf(widgetDict['properties']['title'])].append(len(widgetDict['properties']['metrics']))
+    for lineNums in chainLineMap.values():
+        assert all(lineNum == 10 for lineNum in lineNums[:-1]) and lineNums[-1] <= 10
+    # the multi-metric widget of the template keeps one chain for all its metrics
+    assert len(chainLineMap['pre-aurora-dml-latency']) == 27
+    assert dashboard_custom.runDashboardJob(dict(job, action='sync', tag='env:prod OR env:dev'))['status'] == 'unchanged'
+    assert dashboardWidgets(fake, 'rep') == widgets
+
+def instanceLine(clusterId: str, instanceId: str, role: str, metricName: str = 'CPUUtilization') -> list:
+    return ['AWS/RDS', metricName, 'Role', role, 'DBClusterIdentifier', clusterId, {'label': instanceId + '-' + role, 'region': BENCH_REGION}]
+
+def test_prune_keeps_lines_and_widgets_of_the_user():
+    userLines = [['AWS/RDS', 'CPUUtilization', 'Role', 'WRITER', 'DBClusterIdentifier', 'aurora-1', {'label': 'primary of aurora-1', 'region': BENCH_REGION}],
+                 ['AWS/RDS', 'CPUUtilization', 'DBClusterIdentifier', 'aurora-1']]
+    widgets = [{'type': 'metric', 'x': 0, 'y': 0, 'width': 6, 'height': 6, 'properties': {'title': 'CPU', 'region': BENCH_REGION,
+                'metrics': [instanceLine('aurora-1', 'aurora-1-1', 'WRITER'), instanceLine('aurora-1', 'aurora-1-2', 'READER')] + userLines}},
+               {'type': 'metric', 'x': 6, 'y': 0, 'width': 6, 'height': 6, 'properties': {'title': 'CPU old cluster', 'region': BENCH_REGION,
+                'metrics': [instanceLine('old', 'old-1', 'WRITER')]}}]
+    model = dashboard_custom.DashboardModel(widgets, 'AWS/RDS')
+    assert model.pruneInstances({(BENCH_REGION, 'aurora-1-1', 'WRITER')}) == 1
+    assert [widgetDict['properties']['title'] for widgetDict in model.widgets] == ['CPU', 'CPU old cluster']
+    assert model.widgets[0]['properties']['metrics'] == [instanceLine('aurora-1', 'aurora-1-1', 'WRITER')] + userLines
+    assert model.widgets[1]['properties']['metrics'] == [instanceLine('old', 'old-1', 'WRITER')]
+
+def test_tagging_exit_code_reports_failed_clusters(fakeAws):
+    fakeAws(2)
+    tagArgs = ['--tag', 'env:prod', '--region', BENCH_REGION]
+    assert dashboard_custom.main(['--addtag', '--clusterId', 'bench-00000,bench-00001'] + tagArgs) == 0
+    assert dashboard_custom.main(['--addtag', '--clusterId', 'bench-00000,gone-1'] + tagArgs) == 1
+    assert dashboard_custom.main(['--rmtag', '--clusterId', 'gone-1'] + tagArgs) == 1
+
+def test_cached_dashboard_never_overwrites_console_edits(fakeAws, tmp_path, monkeypatch):
+    fake = fakeAws(4)
+    clusterIds = [cluster['DBClusterIdentifier'] for cluster in fake.clusters]
+    monkeypatch.setattr(dashboard_custom, 'discoveryCache', dashboard_custom.DiscoveryCache(str(tmp_path), 300))
+    job = {'dashName': 'cached', 'region': BENCH_REGION}
+    assert dashboard_custom.runDashboardJob(dict(job, action='init', clusterId=clusterIds[0]))['status'] == 'created'
+    # a widget added in the console within the TTL
+    bodyJson = json.loads(fake.dashboards['cached'])
+    bodyJson['widgets'].append({'type': 'text', 'x': 0, 'y': 100, 'width': 6, 'height': 2, 'properties': {'markdown': 'runbook'}})
+    fake.dashboards['cached'] = json.dumps(bodyJson)
+    assert dashboard_custom.runDashboardJob(dict(job, action='update', clusterId=",".join(clusterIds[:2])))['status'] == 'updated'
+    assert dashboardWidgets(fake, 'cached')[-1]['properties'] == {'markdown': 'runbook'}
+    assert dashboard_custom.runDashboardJob(dict(job, action='sync', clusterId=",".join(clusterIds[:2])))['status'] == 'unchanged'
+    # --download may read the dashboard from the cache
+    fake.dashboards['cached'] = json.dumps({'widgets': []})
+    templateFile = str(tmp_path / 'template.json')
+    assert dashboard_custom.runDashboardJob(dict(job, action='update', clusterId=clusterIds[0], download=templateFile))['status'] == 'downloaded'
+    assert 'runbook' in open(templateFile).read()